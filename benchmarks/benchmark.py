@@ -0,0 +1,356 @@
+"""Offline micro-benchmarks for nyantip's CPU-bound hot paths.
+
+Run from the repository root:
+
+    python benchmarks/benchmark.py                    # run and compare to baseline
+    python benchmarks/benchmark.py --update-baseline  # record a new baseline
+
+None of the benchmarks touch reddit, the coin daemon, or the database. Each
+benchmark reports the best per-call time over several repeats so results are
+comparable across commits on the same machine. The `startup_*` benchmarks time
+a fresh interpreter running a subcommand with the sample config, from parsing
+its arguments and building `NyanTip` up to the first service call, where the
+database engine would be created.
+"""
+
+import argparse
+import atexit
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+
+import yaml
+from jinja2 import Environment, PackageLoader, StrictUndefined
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from nyantip import actions, stats  # noqa: E402
+from nyantip.bot import NyanTip  # noqa: E402
+
+logging.getLogger("nyantip").setLevel(logging.WARNING)
+
+BASELINE_PATH = os.path.join(HERE, "baseline.json")
+SAMPLE_CONFIG_PATH = os.path.join(os.path.dirname(HERE), "nyantip-sample.yml")
+DEFAULT_THRESHOLD = 1.25  # Fail when a benchmark is 25% slower than its baseline
+
+BENCHMARKS = {}
+STARTUP_COMMANDS = {
+    "startup_backup": ["backup"],
+    "startup_cli": ["--help"],
+    "startup_rebuild_stats": ["rebuild-stats"],
+    "startup_run": [],
+}
+# Stops the subcommand where it would first reach a service; every subcommand
+# but `--help` connects to the database before anything else
+STARTUP_CODE = """
+import sys
+
+import sqlalchemy
+
+from nyantip import main
+
+
+def first_service_call(*args, **kwargs):
+    raise SystemExit(0)
+
+
+sqlalchemy.create_engine = first_service_call
+sys.argv[0] = "nyantip"
+main()
+"""
+
+
+def benchmark(number):
+    def decorator(function):
+        BENCHMARKS[function.__name__] = {"function": function, "number": number}
+        return function
+
+    return decorator
+
+
+def load_config():
+    with open(SAMPLE_CONFIG_PATH) as fp:
+        config = yaml.safe_load(fp)
+    NyanTip.config_to_decimal(config["coin"], "minimum_tip")
+    NyanTip.config_to_decimal(config["coin"], "minimum_withdraw")
+    NyanTip.config_to_decimal(config["coin"], "transaction_fee")
+    config["reddit"]["username"] = "nyantipbot"
+    config["reddit"]["subreddit"] = "nyantip"
+    return config
+
+
+def make_nyantip(config):
+    nyantip = NyanTip.__new__(NyanTip)
+    nyantip.coin = SimpleNamespace(config=config["coin"])
+    nyantip.commands = []
+    nyantip.config = config
+    nyantip.templates = Environment(
+        loader=PackageLoader("nyantip"),
+        trim_blocks=True,
+        undefined=StrictUndefined,
+    )
+    nyantip.prepare_commands()
+    return nyantip
+
+
+def make_message(body="", *, author="alice", was_comment=False):
+    return SimpleNamespace(
+        author=SimpleNamespace(name=author),
+        body=body,
+        context="/r/nyantip/comments/abc123/_/def456/?context=3",
+        id="def456",
+        was_comment=was_comment,
+    )
+
+
+def make_rows(count):
+    start = datetime(2021, 6, 26)
+    rows = []
+    for i in range(count):
+        rows.append(
+            {
+                "when": start + timedelta(minutes=i),
+                "action": "tip" if i % 4 else "withdraw",
+                "source": f"user{i % 97}",
+                "destination": (
+                    f"user{i % 89}" if i % 4 else "K8sDLzZ2v9bqP9Ahd1hKbnTxjU8Yg3oTmA"
+                ),
+                "amount": Decimal(i % 1000) + Decimal("0.12345678"),
+                "comment": f"/r/nyantip/comments/abc123/_/c{i:06x}/?context=3",
+                "status": "completed" if i % 7 else "pending",
+            }
+        )
+    return rows
+
+
+CONFIG = load_config()
+NYANTIP = make_nyantip(CONFIG)
+MESSAGES = [
+    (make_message("info"), "message"),
+    (make_message("history"), "message"),
+    (make_message("tip u/bob 12.5"), "message"),
+    (make_message("withdraw K8sDLzZ2v9bqP9Ahd1hKbnTxjU8Yg3oTmA 10"), "message"),
+    (make_message("u/nyantipbot tip 5", was_comment=True), "comment"),
+    (make_message("u/nyantipbot tip u/bob nothing", was_comment=True), "comment"),
+    (make_message("this does not match anything at all"), "message"),
+]
+ROWS = make_rows(5000)
+KEYS = list(ROWS[0].keys())
+TABLE_LINES = [
+    "|".join(stats.format_value(config=CONFIG, key=key, value=row[key]) for key in KEYS)
+    for row in make_rows(40000)
+]
+HISTORY = [
+    [
+        stats.format_value(
+            compact=True, config=CONFIG, key=key, username="user1", value=row[key]
+        )
+        for key in KEYS
+    ]
+    for row in ROWS[:75]
+]
+
+
+@benchmark(number=2000)
+def match_command():
+    for message, message_type in MESSAGES:
+        NYANTIP.match_command(body=message.body, message_type=message_type)
+
+
+@benchmark(number=20)
+def prepare_commands():
+    NYANTIP.commands = []
+    NYANTIP.prepare_commands()
+
+
+@benchmark(number=5000)
+def action_init_amount():
+    actions.Action(
+        action="tip",
+        amount="12.345",
+        destination="bob",
+        message=MESSAGES[2][0],
+        nyantip=NYANTIP,
+    )
+
+
+@benchmark(number=5000)
+def action_init_keyword():
+    actions.Action(
+        action="tip",
+        destination="bob",
+        keyword="nothing",
+        message=MESSAGES[5][0],
+        nyantip=NYANTIP,
+    )
+
+
+@benchmark(number=5)
+def format_value_table():
+    for row in ROWS:
+        for key in KEYS:
+            stats.format_value(config=CONFIG, key=key, username="user1", value=row[key])
+
+
+@benchmark(number=3)
+def wiki_fit_large():
+    stats.wiki_fit(lines=TABLE_LINES)
+
+
+@benchmark(number=2000)
+def render_confirmation():
+    NYANTIP.templates.get_template("confirmation.tpl").render(
+        amount_formatted="12.5 Nyancoin",
+        config=CONFIG,
+        destination="bob",
+        message=MESSAGES[2][0],
+        title="verified",
+        to_address=False,
+        transaction_id=None,
+    )
+
+
+@benchmark(number=200)
+def render_history():
+    NYANTIP.templates.get_template("history.tpl").render(
+        config=CONFIG,
+        cursor=("20200101000000", "abc123"),
+        history=HISTORY,
+        keys=KEYS,
+        message=MESSAGES[1][0],
+        older=False,
+    )
+
+
+def make_config_home():
+    # The sample config, with a coin daemon config to read RPC settings from
+    directory = tempfile.mkdtemp(prefix="nyantip-benchmark-")
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    coin_config_path = os.path.join(directory, "nyancoin.conf")
+    with open(coin_config_path, "w") as fp:
+        fp.write("rpcuser=nyantip\nrpcpassword=nyantip\nrpcport=33700\n")
+    with open(SAMPLE_CONFIG_PATH) as fp:
+        config = yaml.safe_load(fp)
+    config["coin"]["config_file"] = coin_config_path
+    with open(os.path.join(directory, NyanTip.CONFIG_NAME), "w") as fp:
+        yaml.safe_dump(config, fp)
+    return directory
+
+
+def python_startup(arguments):
+    environment = {key: value for key, value in os.environ.items() if key != "APPDATA"}
+    environment["XDG_CONFIG_HOME"] = CONFIG_HOME
+    subprocess.run(
+        [sys.executable, "-c", STARTUP_CODE, *arguments],
+        check=True,
+        cwd=os.path.dirname(HERE),
+        env=environment,
+        stderr=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+CONFIG_HOME = make_config_home()
+for name, arguments in STARTUP_COMMANDS.items():
+    function = lambda arguments=arguments: python_startup(arguments)  # noqa: E731
+    function.__name__ = name
+    benchmark(number=1)(function)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            cwd=HERE,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, repeat):
+    results = {}
+    for name in names:
+        metadata = BENCHMARKS[name]
+        timer = timeit.Timer(metadata["function"])
+        best = min(timer.repeat(number=metadata["number"], repeat=repeat))
+        results[name] = best / metadata["number"]
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"{'benchmark':24} {'per call':>12} {'baseline':>12} {'ratio':>7}")
+    for name, seconds in results.items():
+        previous = baseline.get(name)
+        if previous:
+            ratio = seconds / previous
+            flag = " REGRESSION" if ratio > threshold else ""
+            print(
+                f"{name:24} {seconds * 1e6:10.1f}us {previous * 1e6:10.1f}us {ratio:6.2f}x{flag}"
+            )
+            if flag:
+                regressions.append(name)
+        else:
+            print(f"{name:24} {seconds * 1e6:10.1f}us {'-':>12} {'-':>7}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run nyantip micro-benchmarks")
+    parser.add_argument(
+        "benchmarks",
+        help=f"benchmarks to run (default: all of {', '.join(BENCHMARKS)})",
+        metavar="BENCHMARK",
+        nargs="*",
+    )
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument(
+        "--threshold",
+        default=DEFAULT_THRESHOLD,
+        help="slowdown ratio relative to the baseline treated as a regression",
+        type=float,
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    arguments = parser.parse_args()
+    for name in arguments.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+
+    results = run(arguments.benchmarks or list(BENCHMARKS), repeat=arguments.repeat)
+
+    baseline = {}
+    if os.path.isfile(BASELINE_PATH):
+        with open(BASELINE_PATH) as fp:
+            baseline = json.load(fp)
+
+    regressions = compare(results, baseline.get("results", {}), arguments.threshold)
+
+    if arguments.update_baseline:
+        baseline.setdefault("results", {}).update(results)
+        baseline["python"] = platform.python_version()
+        baseline["revision"] = git_revision()
+        with open(BASELINE_PATH, "w") as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+            fp.write("\n")
+        print(f"baseline written to {BASELINE_PATH}")
+    elif regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,15 +7,121 @@ CREATE TABLE IF NOT EXISTS `actions` (
   `message_timestamp` timestamp NOT NULL,
   `path` varchar(128) DEFAULT NULL,
   `source` varchar(20) NOT NULL,
-  `status` enum('completed','declined','expired','failed','pending') NOT NULL,
+  `status` enum('completed','declined','expired','failed','pending','sending') NOT NULL,
   `transaction_id` varchar(64) DEFAULT NULL,
-  PRIMARY KEY (`message_id`)
+  `updated_at` timestamp NOT NULL DEFAULT NOW() ON UPDATE NOW(),
+  PRIMARY KEY (`message_id`),
+  KEY `destination_message_timestamp` (`destination`, `message_timestamp`),
+  KEY `source_message_timestamp` (`source`, `message_timestamp`),
+  KEY `updated_at` (`updated_at`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 CREATE TABLE IF NOT EXISTS `users` (
   `address` varchar(34) NOT NULL,
   `created_at` timestamp NOT NULL DEFAULT NOW(),
+  `updated_at` timestamp NOT NULL DEFAULT NOW() ON UPDATE NOW(),
   `username` varchar(20) NOT NULL,
   PRIMARY KEY (`username`),
-  UNIQUE KEY `address` (`address`)
+  UNIQUE KEY `address` (`address`),
+  KEY `updated_at` (`updated_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `address_pool` (
+  `address` varchar(34) NOT NULL,
+  `created_at` timestamp NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (`address`),
+  KEY `created_at` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `backups` (
+  `created_at` timestamp NOT NULL DEFAULT NOW(),
+  `high_water_mark` timestamp NOT NULL,
+  `id` int unsigned NOT NULL AUTO_INCREMENT,
+  `kind` enum('full','incremental') NOT NULL,
+  `path` varchar(255) NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `inbox_queue` (
+  `attempts` int unsigned NOT NULL DEFAULT 0,
+  `author` varchar(20) DEFAULT NULL,
+  `body` text NOT NULL,
+  `claimed_by` varchar(64) DEFAULT NULL,
+  `context` varchar(255) DEFAULT NULL,
+  `created_utc` int unsigned NOT NULL,
+  `deferred_at` timestamp NULL DEFAULT NULL,
+  `fullname` varchar(16) NOT NULL,
+  `ingested_utc` int unsigned NOT NULL,
+  `kind` enum('comment','message') NOT NULL,
+  `lease_expires_at` timestamp NULL DEFAULT NULL,
+  `parent_id` varchar(16) DEFAULT NULL,
+  `status` enum('claimed','completed','deferred','failed','queued') NOT NULL DEFAULT 'queued',
+  PRIMARY KEY (`fullname`),
+  KEY `status_created_utc` (`status`, `created_utc`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `dead_letters` (
+  `attempts` int unsigned NOT NULL,
+  `failed_at` timestamp NOT NULL DEFAULT NOW(),
+  `fullname` varchar(16) NOT NULL,
+  `payload` text NOT NULL,
+  `traceback` text NOT NULL,
+  PRIMARY KEY (`fullname`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `leases` (
+  `expires_at` timestamp NOT NULL DEFAULT NOW(),
+  `instance_id` varchar(64) NOT NULL,
+  `name` varchar(32) NOT NULL,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `deposits` (
+  `address` varchar(34) NOT NULL,
+  `amount` decimal(17,8) NOT NULL,
+  `confirmations` int NOT NULL,
+  `created_at` timestamp NOT NULL DEFAULT NOW(),
+  `credited_at` timestamp NULL DEFAULT NULL,
+  `txid` varchar(64) NOT NULL,
+  `updated_at` timestamp NOT NULL DEFAULT NOW() ON UPDATE NOW(),
+  `username` varchar(20) NOT NULL,
+  PRIMARY KEY (`txid`, `address`),
+  KEY `confirmations` (`confirmations`),
+  KEY `updated_at` (`updated_at`),
+  KEY `username_confirmations` (`username`, `confirmations`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `ledger_balances` (
+  `balance` decimal(17,8) NOT NULL DEFAULT 0,
+  `updated_at` timestamp NOT NULL DEFAULT NOW() ON UPDATE NOW(),
+  `username` varchar(20) NOT NULL,
+  PRIMARY KEY (`username`),
+  KEY `updated_at` (`updated_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `ledger_entries` (
+  `account` varchar(20) NOT NULL,
+  `amount` decimal(17,8) NOT NULL,
+  `created_at` timestamp NOT NULL DEFAULT NOW(),
+  `id` bigint unsigned NOT NULL AUTO_INCREMENT,
+  `journal_id` char(32) NOT NULL,
+  `kind` enum('deposit','import','transfer','withdraw') NOT NULL,
+  `reference` varchar(64) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `account_id` (`account`, `id`),
+  KEY `created_at` (`created_at`),
+  KEY `journal_id` (`journal_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `ledger_state` (
+  `name` varchar(32) NOT NULL,
+  `value` varchar(64) NOT NULL,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `wiki_pages` (
+  `content_hash` char(64) NOT NULL,
+  `page` varchar(32) NOT NULL,
+  `updated_at` timestamp NOT NULL DEFAULT NOW() ON UPDATE NOW(),
+  PRIMARY KEY (`page`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
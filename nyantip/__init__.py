@@ -1,8 +1,10 @@
 import argparse
 import logging
 
+from .backup import COMPRESSION
 from .bot import NyanTip
 from .const import __version__  # noqa
+from .tracing import DEFAULT_PATH, summarize
 
 logging.basicConfig(
     datefmt="%H:%M:%S",
@@ -15,11 +17,111 @@ def main():
     parser = argparse.ArgumentParser(
         description="Run nyantip bot or associated utilities"
     )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="run the bot using the asyncio runtime",
+    )
+    parser.add_argument(
+        "--profile",
+        const=0,
+        help="profile the bot from start up for SECONDS (default: profiler.seconds)",
+        metavar="SECONDS",
+        nargs="?",
+        type=float,
+    )
     subparsers = parser.add_subparsers(dest="command", metavar="", title="subcommands")
-    subparsers.add_parser("backup", help="Backup config, database, and wallet")
+    backup_parser = subparsers.add_parser(
+        "backup", help="Backup config, database, and wallet"
+    )
+    backup_parser.add_argument(
+        "--compression",
+        choices=sorted(COMPRESSION),
+        default="deflate",
+        help="compression algorithm for the backup archive (default: deflate)",
+    )
+    backup_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only back up actions and users changed since the previous backup",
+    )
+    backup_parser.add_argument(
+        "--level",
+        help="compression level, e.g., 1 (fastest) through 9 (smallest)",
+        type=int,
+    )
+
+    dead_letters_parser = subparsers.add_parser(
+        "dead-letters", help="List, inspect, or re-drive inbox items that kept failing"
+    )
+    dead_letters_parser.add_argument(
+        "fullnames",
+        help="show the payload and traceback of these items (default: list all)",
+        metavar="FULLNAME",
+        nargs="*",
+    )
+    dead_letters_parser.add_argument(
+        "--redrive",
+        action="store_true",
+        help="queue the items (default: all) to be processed again",
+    )
+
+    subparsers.add_parser(
+        "ledger-import",
+        help="Open the internal ledger with the wallet's account balances",
+    )
+
+    rebuild_parser = subparsers.add_parser(
+        "rebuild-stats", help="Rebuild every user's stats wiki page"
+    )
+    rebuild_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="publish pages even if they haven't changed since the last rebuild",
+    )
+    rebuild_parser.add_argument(
+        "--workers",
+        default=4,
+        help="number of pages rendered and published at once (default: 4)",
+        type=int,
+    )
+
+    restore_parser = subparsers.add_parser(
+        "restore-incremental",
+        help="Replay incremental backups on top of a restored full backup",
+    )
+    restore_parser.add_argument("paths", metavar="PATH", nargs="+")
+
+    trace_parser = subparsers.add_parser(
+        "trace-summary", help="Summarize where time goes per action type"
+    )
+    trace_parser.add_argument(
+        "path",
+        help="trace file to summarize (default: tracing.path from the config file)",
+        metavar="PATH",
+        nargs="?",
+    )
 
     arguments = parser.parse_args()
     if arguments.command == "backup":
-        NyanTip().backup()
+        NyanTip().backup(
+            compression=arguments.compression,
+            compresslevel=arguments.level,
+            incremental=arguments.incremental,
+        )
+    elif arguments.command == "dead-letters":
+        NyanTip().dead_letters(fullnames=arguments.fullnames, redrive=arguments.redrive)
+    elif arguments.command == "ledger-import":
+        NyanTip().import_ledger()
+    elif arguments.command == "rebuild-stats":
+        NyanTip().rebuild_stats(force=arguments.force, workers=arguments.workers)
+    elif arguments.command == "restore-incremental":
+        NyanTip().restore_incremental(paths=arguments.paths)
+    elif arguments.command == "trace-summary":
+        summarize(
+            arguments.path
+            or (NyanTip.parse_config().get("tracing") or {}).get("path")
+            or DEFAULT_PATH
+        )
     else:
-        NyanTip().run()
+        NyanTip().run(profile_seconds=arguments.profile, use_asyncio=arguments.asyncio)
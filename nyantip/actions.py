@@ -16,6 +16,9 @@
 """
 
 import logging
+import re
+from collections import namedtuple
+from datetime import datetime
 from decimal import Decimal
 from functools import partial
 
@@ -23,10 +26,17 @@ from praw.exceptions import ClientException
 from praw.models import Comment
 
 from . import stats, user
+from .rpc import CircuitOpen
 from .util import DummyMessage
 
 logger = logging.getLogger(__package__)
 
+HISTORY_CURSOR_FORMAT = "%Y%m%d%H%M%S"
+HISTORY_OLDER_REGEX = re.compile(
+    r"\bolder(?:\s+(\d{14})\s+(\w+))?\s*$", re.IGNORECASE | re.MULTILINE
+)
+HISTORY_PAGE_SIZE = 75  # rows
+
 
 class Action(object):
     def __init__(
@@ -89,16 +99,59 @@ class Action(object):
     def _format_coin(self, quantity):
         return f"{quantity:f} {self.nyantip.config['coin']['name']}"
 
+    def _history_page(self, *, cursor):
+        database = self.nyantip.read_database
+        # One row more than a page is fetched to tell whether there are older ones
+        arguments = {"limit": HISTORY_PAGE_SIZE + 1, "username": self.source}
+        if cursor:
+            arguments["when"], arguments["message_id"] = cursor
+            response = database.execute(
+                self.nyantip.config["sql"]["history_older"], arguments
+            )
+        else:
+            response = database.execute(
+                self.nyantip.config["sql"]["history"], arguments
+            )
+
+        # `when` and `message_id` of the last row shown form the keyset cursor
+        # for the next page, which is sent back in the `history older` command
+        keys = [key for key in response.keys() if key != "message_id"]
+        rows = response.fetchall()
+        history = []
+        next_cursor = None
+        if len(rows) > HISTORY_PAGE_SIZE:
+            rows = rows[:HISTORY_PAGE_SIZE]
+            next_cursor = (
+                rows[-1]["when"].strftime(HISTORY_CURSOR_FORMAT),
+                rows[-1]["message_id"],
+            )
+        for row in rows:
+            history_entry = []
+            for key in keys:
+                history_entry.append(
+                    stats.format_value(
+                        config=self.nyantip.config,
+                        compact=True,
+                        key=key,
+                        username=self.source.name,
+                        value=row[key],
+                    )
+                )
+            history.append(history_entry)
+        return {"cursor": next_cursor, "history": history, "keys": keys}
+
     def _safe_send(self, *, amount=None, destination, on_success, source):
         if amount is None:
             amount = self.amount
 
         try:
-            self.nyantip.coin.send(
+            self.nyantip.accounts.send(
                 amount=amount,
                 destination=destination,
                 source=source,
             )
+        except CircuitOpen:
+            raise  # The item is deferred until the coin daemon is available
         except Exception:
             logger.exception(f"action_{self.action}(): failed")
             return self._fail(
@@ -109,19 +162,113 @@ class Action(object):
                 destination=None,
                 to_address=False,
             )
+        self._undo_on_rollback(amount=amount, destination=destination, source=source)
+        on_success()
+        return True
+
+    def _settle(self, *, destinations, pending_actions, status):
+        # Release the escrow of every pending tip at once with one transfer per
+        # recipient and a single update of their rows, undoing the transfers if
+        # any step fails. Tippers are notified by the caller afterwards.
+        transfers = {}
+        for action, destination in zip(pending_actions, destinations):
+            key = destination.name.lower()
+            amount = transfers.get(key, (destination, 0))[1] + action.amount
+            transfers[key] = (destination, amount)
+
+        completed = []
+        message_ids = [action.message.id for action in pending_actions]
         try:
-            on_success()
-        except Exception:
-            # If the callback fails, we need to undo the send
-            logger.warning("rolling back the previous transfer")
-            self.nyantip.coin.send(
-                amount=amount,
-                destination=source,
-                source=destination,
+            with self.nyantip.transaction() as connection:
+                for destination, amount in transfers.values():
+                    self.nyantip.accounts.send(
+                        amount=amount, destination=destination, source=self.nyantip.bot
+                    )
+                    completed.append((destination, amount))
+                result = connection.execute(
+                    f"UPDATE actions SET status = %s WHERE status = 'pending' AND message_id IN ({', '.join(['%s'] * len(message_ids))})",
+                    (status, *message_ids),
+                )
+                if result.rowcount != len(message_ids):
+                    raise Exception(
+                        f"settled {result.rowcount} of {len(message_ids)} pending tip(s)"
+                    )
+        except Exception as exception:
+            if isinstance(exception, CircuitOpen) and not completed:
+                raise  # Nothing was moved yet, so the item can be deferred
+            logger.exception(f"action_{self.action}(): failed")
+            if not self.nyantip.ledger:  # Ledger transfers were rolled back
+                self._unsettle(
+                    completed=completed,
+                    destinations=destinations,
+                    pending_actions=pending_actions,
+                    status=status,
+                )
+            return self._fail(
+                f"{self.action} failed",
+                "tip-went-wrong.tpl",
+                action_name=self.action,
+                amount_formatted=self._format_coin(
+                    sum(action.amount for action in pending_actions)
+                ),
+                destination=None,
+                to_address=False,
+            )
+
+        for destination, amount in completed:
+            self._undo_on_rollback(
+                amount=amount, destination=destination, source=self.nyantip.bot
             )
-            raise
+        for action in pending_actions:
+            for username in (action.source.name, action.destination.name):
+                self.nyantip.after_commit(
+                    partial(self.nyantip.history_cache.pop, username.lower())
+                )
         return True
 
+    def _undo_on_rollback(self, *, amount, destination, source):
+        # Ledger transfers roll back with the unit of work; wallet moves don't
+        if not self.nyantip.ledger:
+            self.nyantip.on_rollback(
+                partial(
+                    self.nyantip.accounts.send,
+                    amount=amount,
+                    destination=source,
+                    source=destination,
+                )
+            )
+
+    def _unsettle(self, *, completed, destinations, pending_actions, status):
+        # Moves released escrow back to the bot. A recipient whose move can't be
+        # undone, e.g., while the circuit is open, keeps it, so their tips are
+        # settled after all rather than left pending to be settled again.
+        if completed:
+            logger.warning("rolling back the previous transfers")
+        stranded = set()
+        for destination, amount in reversed(completed):
+            try:
+                self.nyantip.accounts.send(
+                    amount=amount, destination=self.nyantip.bot, source=destination
+                )
+            except Exception:
+                logger.exception(f"rolling back the transfer to {destination} failed")
+                stranded.add(destination.name.lower())
+        message_ids = [
+            action.message.id
+            for action, destination in zip(pending_actions, destinations)
+            if destination.name.lower() in stranded
+        ]
+        if not message_ids:
+            return
+        self.nyantip.execute(
+            f"UPDATE actions SET status = %s WHERE status = 'pending' AND message_id IN ({', '.join(['%s'] * len(message_ids))})",
+            (status, *message_ids),
+        )
+        self.nyantip.failures.add(
+            error=f"escrow released to {', '.join(sorted(stranded))} could not be moved back; marked {status}",
+            name=f"{self.action} {self.message.id}",
+        )
+
     def action_accept(self):
         pending_actions = actions(
             action="tip",
@@ -135,18 +282,16 @@ class Action(object):
         if not self.source.is_registered():
             self.source.register()
 
+        if not self._settle(
+            destinations=[self.source] * len(pending_actions),
+            pending_actions=pending_actions,
+            status="completed",
+        ):
+            return
+
         users_to_update = set()
         for action in pending_actions:
-            if not self._safe_send(
-                amount=action.amount,
-                destination=self.source,
-                on_success=partial(action.save, status="completed"),
-                source=self.nyantip.bot,
-            ):
-                self.save(status="failed")
-                return
             users_to_update.add(action.source.name)
-
             response = self.nyantip.templates.get_template("confirmation.tpl").render(
                 amount_formatted=action._amount_formatted,
                 config=self.nyantip.config,
@@ -167,9 +312,12 @@ class Action(object):
         self.action = "info"
         self.action_info(save=False)
 
-        stats.update_user_stats(nyantip=self.nyantip, username=self.source.name)
-        for username in users_to_update:
-            stats.update_user_stats(nyantip=self.nyantip, username=username)
+        for username in {self.source.name, *users_to_update}:
+            self.nyantip.after_commit(
+                partial(
+                    stats.update_user_stats, nyantip=self.nyantip, username=username
+                )
+            )
 
     def action_decline(self):
         pending_actions = actions(
@@ -181,16 +329,14 @@ class Action(object):
         if not pending_actions:
             return self._fail("decline failed", "no-pending-tips.tpl")
 
-        for action in pending_actions:
-            if not self._safe_send(
-                amount=action.amount,
-                destination=action.source,
-                on_success=partial(action.save, status="declined"),
-                source=self.nyantip.bot,
-            ):
-                self.save(status="failed")
-                return
+        if not self._settle(
+            destinations=[action.source for action in pending_actions],
+            pending_actions=pending_actions,
+            status="declined",
+        ):
+            return
 
+        for action in pending_actions:
             response = self.nyantip.templates.get_template("confirmation.tpl").render(
                 amount_formatted=action._amount_formatted,
                 config=self.nyantip.config,
@@ -216,49 +362,53 @@ class Action(object):
         )
 
     def action_history(self):
-        history = []
-
-        response = self.nyantip.database.execute(
-            self.nyantip.config["sql"]["history"], (self.source, self.source)
-        )
-        for row in response:
-            history_entry = []
-            for key in response.keys():
-                history_entry.append(
-                    stats.format_value(
-                        config=self.nyantip.config,
-                        compact=True,
-                        key=key,
-                        username=self.source.name,
-                        value=row[key],
-                    )
+        username = self.source.name.lower()
+        match = HISTORY_OLDER_REGEX.search(self.message.body)
+        cursor = None
+        if match:
+            try:
+                cursor = (
+                    datetime.strptime(match.group(1), HISTORY_CURSOR_FORMAT),
+                    match.group(2),
                 )
-            history.append(history_entry)
+            except (TypeError, ValueError):
+                logger.debug(
+                    f"history({self.source}): no valid cursor; showing the first page"
+                )
+        older = cursor is not None
+
+        page = None if older else self.nyantip.history_cache.get(username)
+        if page is None:
+            page = self._history_page(cursor=cursor)
+            if not older and not (self.nyantip.cluster or self.nyantip.replica):
+                # Other instances' writes would not invalidate this cache, and a
+                # page read from a lagging replica could outlive the lag
+                self.nyantip.history_cache.set(username, page)
 
-        if history:
+        if page["history"]:
             response = self.nyantip.templates.get_template("history.tpl").render(
                 config=self.nyantip.config,
-                history=history,
-                keys=response.keys(),
+                cursor=page["cursor"],
+                history=page["history"],
+                keys=page["keys"],
                 message=self.message,
+                older=older,
             )
         else:
             response = self.nyantip.templates.get_template("history-empty.tpl").render(
                 config=self.nyantip.config,
                 message=self.message,
+                older=older,
             )
-        self.message.reply(response)
+        self.nyantip.after_commit(partial(self.message.reply, response))
         self.save(status="completed")
 
     def action_info(self, save=True):
         if not self.source.is_registered():
             return self._fail("info failed", "not-registered.tpl", save=save)
 
-        balance = self.nyantip.coin.balance(
-            minconf=self.nyantip.coin.config["minconf"]["tip"],
-            user=self.source.name,
-        )
-        address = self.nyantip.database.execute(
+        balance = self.source.balance(kind="tip")
+        address = self.nyantip.execute(
             "SELECT address FROM users WHERE username = %s", self.source
         ).scalar_one()
 
@@ -269,7 +419,7 @@ class Action(object):
             config=self.nyantip.config,
             message=self.message,
         )
-        self.message.reply(response)
+        self.nyantip.after_commit(partial(self.message.reply, response))
 
         if save:
             self.save(status="completed")
@@ -325,42 +475,27 @@ class Action(object):
         )
         self.destination.message(body=response, subject="tip received")
 
-        stats.update_user_stats(nyantip=self.nyantip, username=self.source.name)
-        stats.update_user_stats(nyantip=self.nyantip, username=self.destination.name)
+        for username in (self.source.name, self.destination.name):
+            self.nyantip.after_commit(
+                partial(
+                    stats.update_user_stats, nyantip=self.nyantip, username=username
+                )
+            )
 
     def action_withdraw(self):
         assert self.destination
         if not self.validate():
             return
 
-        try:
-            self.transaction_id = self.nyantip.coin.transfer(
-                address=self.destination, amount=self.amount, source=self.source.name
-            )
-        except Exception:
-            logger.exception("action_withdraw(): failed")
-            return self._fail(
-                "withdraw failed",
-                "tip-went-wrong.tpl",
-                action_name=self.action,
-                amount_formatted=self._amount_formatted,
-                destination=self.destination,
-                to_address=True,
-            )
-
-        self.save(status="completed")
-        response = self.nyantip.templates.get_template("confirmation.tpl").render(
-            amount_formatted=self._amount_formatted,
-            config=self.nyantip.config,
-            destination=self.destination,
-            message=self.message,
-            title="verified",
-            to_address=True,
-            transaction_id=self.transaction_id,
-        )
-        self.source.message(
-            body=response, message=self.message, subject="withdraw succeeded"
-        )
+        # Hold the amount and fee until the withdrawal is sent. The pending row
+        # is committed first, so a retried item can never send it twice.
+        if self._safe_send(
+            amount=self.amount + self.nyantip.config["coin"]["transaction_fee"],
+            destination=self.nyantip.withdrawals.account,
+            on_success=partial(self.save, status="pending"),
+            source=self.source,
+        ):
+            self.nyantip.withdrawals.add(self)
 
     def expire(self):
         if not self._safe_send(
@@ -381,6 +516,31 @@ class Action(object):
         )
         self.source.message(body=response, message=self.message, subject="tip expired")
 
+    def notify_withdraw(self):
+        response = self.nyantip.templates.get_template("confirmation.tpl").render(
+            amount_formatted=self._amount_formatted,
+            config=self.nyantip.config,
+            destination=self.destination,
+            message=self.message,
+            title="verified",
+            to_address=True,
+            transaction_id=self.transaction_id,
+        )
+        self.source.message(
+            body=response, message=self.message, subject="withdraw succeeded"
+        )
+
+    def notify_withdraw_failed(self, *, save=False):
+        return self._fail(
+            "withdraw failed",
+            "tip-went-wrong.tpl",
+            action_name=self.action,
+            amount_formatted=self._amount_formatted,
+            destination=self.destination,
+            save=save,
+            to_address=True,
+        )
+
     def perform(self):
         if self.action == "accept":
             self.action_accept()
@@ -410,8 +570,10 @@ class Action(object):
                     self.message.refresh()
                 permalink = f"{self.message.permalink}?context=3"
 
-        result = self.nyantip.database.execute(
-            "REPLACE INTO actions (action, amount, destination, message_id, message_timestamp, path, source, status, transaction_id) VALUES (%s, %s, %s, %s, FROM_UNIXTIME(%s), %s, %s, %s, %s)",
+        # `message_id` is the idempotency key: saving an action again, e.g. when
+        # a pending tip is settled or an inbox item is retried, updates its row
+        result = self.nyantip.execute(
+            "INSERT INTO actions (action, amount, destination, message_id, message_timestamp, path, source, status, transaction_id) VALUES (%s, %s, %s, %s, FROM_UNIXTIME(%s), %s, %s, %s, %s) ON DUPLICATE KEY UPDATE amount = VALUES(amount), destination = VALUES(destination), path = VALUES(path), status = VALUES(status), transaction_id = VALUES(transaction_id)",
             (
                 self.action,
                 self.amount,
@@ -426,6 +588,20 @@ class Action(object):
         )
         assert 1 <= result.rowcount <= 2
 
+        if self.action in ("tip", "withdraw"):
+            # Invalidate the cached history of everyone involved in this action
+            # once it's committed, so a concurrent `history` can't cache the
+            # page from before it
+            self.nyantip.after_commit(
+                partial(self.nyantip.history_cache.pop, self.source.name.lower())
+            )
+            if isinstance(self.destination, user.User):
+                self.nyantip.after_commit(
+                    partial(
+                        self.nyantip.history_cache.pop, self.destination.name.lower()
+                    )
+                )
+
     def validate(self):
         subject = f"{self.action} failed"
 
@@ -483,11 +659,14 @@ class Action(object):
 
             if not self.destination.is_registered():
                 # Perform a pending transfer to escrow
-                self.nyantip.coin.send(
+                self.nyantip.accounts.send(
                     amount=self.amount,
                     destination=self.nyantip.bot,
                     source=self.source,
                 )
+                self._undo_on_rollback(
+                    amount=self.amount, destination=self.nyantip.bot, source=self.source
+                )
                 self.save(status="pending")
 
                 response = self.nyantip.templates.get_template(
@@ -526,73 +705,145 @@ class Action(object):
         return True
 
 
-def actions(
-    *,
-    action=None,
-    created_at=None,
-    destination=None,
-    message_id=None,
-    nyantip=None,
-    source=None,
-    status=None,
-    _check=False,
+# Lightweight, read-only view of a saved action.
+#
+# Built straight from an `actions` row without contacting reddit or parsing
+# amounts, for callers that only need the stored values. `to_action` creates
+# the full `Action` once something will actually be sent for it.
+class ActionRow(
+    namedtuple(
+        "ActionRow",
+        ("action", "amount", "destination", "message_id", "path", "source", "status"),
+    )
 ):
+    __slots__ = ()
+
+    def to_action(self, *, nyantip):
+        if self.path is not None:
+            message = nyantip.reddit.comment(self.message_id)
+        else:
+            message = nyantip.reddit.inbox.message(self.message_id)
+
+        try:
+            if message.author is None:
+                logger.warning("Cannot process item missing author. %r", message)
+                return None
+        except ClientException:
+            logger.warning("Cannot access item. %r", message)
+            return None
+
+        return Action(
+            action=self.action,
+            amount=None if self.amount is None else self.amount.normalize(),
+            destination=self.destination,
+            message=message,
+            nyantip=nyantip,
+        )
+
+
+def _where(*, action, created_at, destination, message_id, source, status):
     arguments = []
     filters = []
-    for attribute in ("action", "message_id", "destination", "source", "status"):
-        value = locals()[attribute]
+    for attribute, value in (
+        ("action", action),
+        ("message_id", message_id),
+        ("destination", destination),
+        ("source", source),
+        ("status", status),
+    ):
         if value:
             arguments.append(value)
             filters.append(f"{attribute} = %s")
 
     if created_at:
         filters.append(created_at)
+    return f" WHERE {' AND '.join(filters)}", arguments
 
-    sql_where = f" WHERE {' AND '.join(filters)}"
-    sql = f"SELECT * FROM actions{sql_where}"
 
-    logger.debug(f"query: {sql} {arguments}")
-    response = nyantip.database.execute(sql, arguments)
+def action_rows(
+    *,
+    action=None,
+    created_at=None,
+    destination=None,
+    message_id=None,
+    nyantip,
+    source=None,
+    status=None,
+):
+    sql_where, arguments = _where(
+        action=action,
+        created_at=created_at,
+        destination=destination,
+        message_id=message_id,
+        source=source,
+        status=status,
+    )
+    sql = f"SELECT {', '.join(ActionRow._fields)} FROM actions{sql_where}"
 
-    if _check:
-        return response.rowcount > 0
+    logger.debug(f"query: {sql} {arguments}")
+    return [ActionRow(*row) for row in nyantip.execute(sql, arguments)]
 
-    if response.rowcount <= 0:
-        return []
 
+def actions(
+    *,
+    action=None,
+    created_at=None,
+    destination=None,
+    message_id=None,
+    nyantip=None,
+    source=None,
+    status=None,
+):
     results = []
-    for row in response:
-        logger.debug(f"actions(): found {row['message_id']}")
-
-        amount = row["amount"]
-        if amount is not None:
-            amount = amount.normalize()
-
-        if row["path"] is not None:
-            message = nyantip.reddit.comment(row["message_id"])
-        else:
-            message = nyantip.reddit.inbox.message(row["message_id"])
+    for row in action_rows(
+        action=action,
+        created_at=created_at,
+        destination=destination,
+        message_id=message_id,
+        nyantip=nyantip,
+        source=source,
+        status=status,
+    ):
+        logger.debug(f"actions(): found {row.message_id}")
+        result = row.to_action(nyantip=nyantip)
+        if result is not None:
+            results.append(result)
+    return results
 
-        try:
-            if message.author is None:
-                logger.warning("Cannot process item missing author. %r", message)
-                continue
-        except ClientException:
-            logger.warning("Cannot access item. %r", message)
-            continue
 
-        results.append(
-            Action(
-                action=action,
-                amount=amount,
-                destination=row["destination"],
-                message=message,
-                nyantip=nyantip,
-            )
+def check_action(
+    *,
+    action=None,
+    destination=None,
+    message_id=None,
+    nyantip,
+    source=None,
+    status=None,
+):
+    sql_where, arguments = _where(
+        action=action,
+        created_at=None,
+        destination=destination,
+        message_id=message_id,
+        source=source,
+        status=status,
+    )
+    return bool(
+        nyantip.execute(f"SELECT 1 FROM actions{sql_where} LIMIT 1", arguments).first()
+    )
+
+
+def pending_tip_counts(*, nyantip):
+    return {
+        row["destination"]: row["count"]
+        for row in nyantip.execute(
+            "SELECT destination, COUNT(*) AS count FROM actions WHERE action = 'tip' AND status = 'pending' GROUP BY destination"
         )
-
-    return results
+    }
 
 
-def check_action(**kwargs):
-    return actions(**kwargs, _check=True)
+def pending_tip_total(*, nyantip):
+    total = nyantip.execute(
+        "SELECT SUM(amount) FROM actions WHERE action = 'tip' AND status = 'pending'"
+    ).scalar_one()
+    return Decimal(0) if total is None else total.normalize()
@@ -0,0 +1,83 @@
+import logging
+import threading
+from functools import partial
+
+logger = logging.getLogger(__package__)
+
+POOL_ACCOUNT = "@pool"
+REFILL_INTERVAL = 300  # seconds
+
+
+# Pool of pre-generated deposit addresses backed by the `address_pool` table.
+#
+# Registration claims an address from the pool and assigns it to the user's
+# wallet account with `setaccount`, so users don't wait on `getnewaddress` (and
+# possibly a wallet unlock). A background thread tops the pool back up to
+# `high_watermark` addresses whenever it falls below `low_watermark`.
+class AddressPool:
+    def __init__(self, *, config, nyantip):
+        self.high_watermark = int(config.get("high_watermark", 100))
+        self.low_watermark = int(config.get("low_watermark", 20))
+        self.nyantip = nyantip
+        self._refill_needed = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def _refill_loop(self):
+        while not self._stopped:
+            self._refill_needed.wait(REFILL_INTERVAL)
+            self._refill_needed.clear()
+            if self._stopped:
+                break
+            try:
+                self.refill()
+            except Exception:
+                logger.exception("refilling the address pool failed")
+
+    def claim(self, *, user):
+        # The row is only deleted if the caller's unit of work commits
+        with self.nyantip.transaction() as connection:
+            address = connection.execute(
+                "SELECT address FROM address_pool ORDER BY created_at LIMIT 1 FOR UPDATE SKIP LOCKED"
+            ).scalar_one_or_none()
+            if not address:
+                logger.warning("the address pool is empty")
+                self._refill_needed.set()
+                return None
+            connection.execute("DELETE FROM address_pool WHERE address = %s", address)
+            self.nyantip.coin.connection.setaccount(address, user)
+        self.nyantip.on_rollback(
+            partial(self.nyantip.coin.connection.setaccount, address, POOL_ACCOUNT)
+        )
+        self._refill_needed.set()
+        return address
+
+    def refill(self):
+        count = self.nyantip.database.execute(
+            "SELECT COUNT(*) FROM address_pool"
+        ).scalar_one()
+        if count >= self.low_watermark:
+            return
+
+        needed = self.high_watermark - count
+        coin = self.nyantip.coin
+        with coin.wallet.unlocked():
+            addresses = [
+                coin.generate_address(user=POOL_ACCOUNT) for _ in range(needed)
+            ]
+        self.nyantip.database.execute(
+            f"INSERT INTO address_pool (address) VALUES {', '.join(['(%s)'] * needed)}",
+            addresses,
+        )
+        logger.info(f"added {needed} address(es) to the address pool")
+
+    def start(self):
+        self._thread = threading.Thread(
+            daemon=True, name="nyantip-address-pool", target=self._refill_loop
+        )
+        self._thread.start()
+        self._refill_needed.set()
+
+    def stop(self):
+        self._stopped = True
+        self._refill_needed.set()
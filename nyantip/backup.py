@@ -0,0 +1,313 @@
+import gzip
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime
+
+logger = logging.getLogger(__package__)
+
+CHUNK_SIZE = 1024 * 1024  # Bytes
+COMPRESSION = {
+    "bzip2": zipfile.ZIP_BZIP2,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "lzma": zipfile.ZIP_LZMA,
+    "store": zipfile.ZIP_STORED,
+}
+INCREMENTAL_OVERLAP = 60  # seconds; rows committed late may carry earlier timestamps
+# Table to the column that marks its rows as changed; None exports every row
+INCREMENTAL_TABLES = {"actions": "updated_at", "users": "updated_at"}
+LEDGER_INCREMENTAL_TABLES = {
+    "deposits": "updated_at",
+    "ledger_balances": "updated_at",
+    "ledger_entries": "created_at",
+    "ledger_state": None,
+}
+PROGRESS_INTERVAL = 10  # seconds
+
+
+class CountingWriter:
+    def __init__(self, fp):
+        self.bytes_written = 0
+        self.fp = fp
+
+    def flush(self):
+        self.fp.flush()
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.fp.write(data)
+
+
+def backup(*, coin, compression, compresslevel, config, config_path, database):
+    backup_name = f"backup_nyantip_{datetime.now().strftime('%Y%m%d%H%M')}"
+    high_water_mark = database.execute("SELECT NOW()").scalar_one()
+    start = time.monotonic()
+
+    def write(fp):
+        output = CountingWriter(fp)
+        write_archive(
+            backup_name=backup_name,
+            coin=coin,
+            compression=COMPRESSION[compression],
+            compresslevel=compresslevel,
+            config=config,
+            config_path=config_path,
+            output=output,
+        )
+        return output.bytes_written
+
+    path, size = save(config=config, path=f"{backup_name}.zip", write=write)
+    record_backup(
+        database=database, high_water_mark=high_water_mark, kind="full", path=path
+    )
+
+    duration = time.monotonic() - start
+    logger.info(
+        f"backup written to {path}: {format_size(size)} archive in {duration:.1f} seconds"
+    )
+    return path
+
+
+def backup_incremental(*, compresslevel, config, database):
+    previous_mark = database.execute(
+        "SELECT MAX(high_water_mark) FROM backups"
+    ).scalar_one()
+    if previous_mark is None:
+        raise Exception("incremental backups require a previous full backup")
+    high_water_mark = database.execute("SELECT NOW()").scalar_one()
+    backup_name = (
+        f"backup_nyantip_incremental_{high_water_mark.strftime('%Y%m%d%H%M%S')}"
+    )
+    counts = {}
+
+    def write(fp):
+        output = CountingWriter(fp)
+        with gzip.GzipFile(
+            compresslevel=9 if compresslevel is None else compresslevel,
+            fileobj=output,
+            mode="wb",
+        ) as gzip_fp:
+            header = {
+                "high_water_mark": high_water_mark,
+                "previous_mark": previous_mark,
+            }
+            gzip_fp.write(json.dumps(header, default=str).encode() + b"\n")
+            for table, column in incremental_tables(config).items():
+                counts[table] = 0
+                where = f" WHERE {column} >= %s - INTERVAL %s SECOND" if column else ""
+                for row in database.execution_options(stream_results=True).execute(
+                    f"SELECT * FROM {table}{where}",
+                    (previous_mark, INCREMENTAL_OVERLAP) if column else (),
+                ):
+                    record = {"row": dict(row), "table": table}
+                    gzip_fp.write(
+                        json.dumps(record, default=str, separators=(",", ":")).encode()
+                        + b"\n"
+                    )
+                    counts[table] += 1
+        return output.bytes_written
+
+    path, size = save(config=config, path=f"{backup_name}.jsonl.gz", write=write)
+    record_backup(
+        database=database,
+        high_water_mark=high_water_mark,
+        kind="incremental",
+        path=path,
+    )
+    logger.info(
+        f"incremental backup written to {path}: {format_size(size)} with "
+        + ", ".join(f"{count} {table} row(s)" for table, count in counts.items())
+        + f" changed since {previous_mark}"
+    )
+    return path
+
+
+def copy_stream(*, destination, name, source):
+    start = last_report = time.monotonic()
+    total = 0
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        destination.write(chunk)
+        total += len(chunk)
+
+        now = time.monotonic()
+        if now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            logger.info(
+                f"backup {name}: {format_size(total)} at {format_size(total / (now - start))}/s"
+            )
+    duration = max(time.monotonic() - start, 0.001)
+    logger.info(
+        f"backup {name}: {format_size(total)} in {duration:.1f} seconds ({format_size(total / duration)}/s)"
+    )
+
+
+def decrypt(*, passphrase, path):
+    import gnupg
+
+    with open(path, "rb") as fp:
+        result = gnupg.GPG().decrypt_file(fp, passphrase=passphrase)
+    if not result.ok:
+        raise Exception(f"gpg decryption of {path} failed: {result.status}")
+    return result.data
+
+
+def encrypt(*, passphrase, path, write):
+    import gnupg
+
+    # The archive is written into a pipe from another thread while gpg reads the
+    # other end, so neither the plaintext nor the archive touches the disk.
+    errors = []
+    read_fd, write_fd = os.pipe()
+    size = []
+
+    def writer():
+        try:
+            with os.fdopen(write_fd, "wb") as fp:
+                size.append(write(fp))
+        except BaseException as exception:
+            errors.append(exception)
+
+    thread = threading.Thread(name="nyantip-backup", target=writer)
+    with os.fdopen(read_fd, "rb") as fp:
+        thread.start()
+        result = gnupg.GPG().encrypt_file(
+            fp,
+            output=path,
+            passphrase=passphrase,
+            recipients=None,
+            symmetric="AES256",
+        )
+    thread.join()
+
+    if errors or not result.ok:
+        if os.path.exists(path):
+            os.remove(path)
+        if errors:
+            raise errors[0]
+        raise Exception(f"gpg encryption failed: {result.status}")
+    return size[0]
+
+
+def format_size(size):
+    return f"{size / 1024 / 1024:.1f} MiB"
+
+
+def incremental_tables(config):
+    if (config.get("ledger") or {}).get("enabled"):
+        return {**INCREMENTAL_TABLES, **LEDGER_INCREMENTAL_TABLES}
+    return INCREMENTAL_TABLES
+
+
+def record_backup(*, database, high_water_mark, kind, path):
+    database.execute(
+        "INSERT INTO backups (high_water_mark, kind, path) VALUES (%s, %s, %s)",
+        (high_water_mark, kind, path),
+    )
+
+
+def restore_incremental(*, config, database, paths):
+    # The restored `backups` table ends with the backups taken before the full
+    # backup's dump, so increments up to that mark hold older state
+    restored_mark = database.execute(
+        "SELECT MAX(high_water_mark) FROM backups"
+    ).scalar_one()
+    increments = []
+    for path in paths:
+        if path.endswith(".gpg"):
+            data = decrypt(passphrase=config["backup_passphrase"], path=path)
+        else:
+            with open(path, "rb") as fp:
+                data = fp.read()
+        lines = gzip.decompress(data).splitlines()
+        if not lines or "high_water_mark" not in json.loads(lines[0]):
+            raise Exception(f"{path} has no high-water mark")
+        mark = datetime.fromisoformat(json.loads(lines.pop(0))["high_water_mark"])
+        if restored_mark is not None and mark <= restored_mark:
+            logger.info(f"skipping {path}: taken before the restored full backup")
+            continue
+        increments.append((mark, path, lines))
+
+    # Replay increments in the order they were taken
+    tables = {**INCREMENTAL_TABLES, **LEDGER_INCREMENTAL_TABLES}
+    for _, path, lines in sorted(increments):
+        count = 0
+        with database.begin() as connection:
+            for line in lines:
+                record = json.loads(line)
+                table = record["table"]
+                assert table in tables
+                columns = sorted(record["row"])
+                connection.execute(
+                    f"REPLACE INTO {table} ({', '.join(f'`{column}`' for column in columns)}) VALUES ({', '.join(['%s'] * len(columns))})",
+                    [record["row"][column] for column in columns],
+                )
+                count += 1
+        logger.info(f"restored {count} row(s) from {path}")
+
+
+def save(*, config, path, write):
+    passphrase = config["backup_passphrase"]
+    if passphrase:
+        path = f"{path}.gpg"
+        return path, encrypt(passphrase=passphrase, path=path, write=write)
+
+    try:
+        with open(path, "wb") as fp:
+            return path, write(fp)
+    except BaseException:
+        os.remove(path)
+        raise
+
+
+def write_archive(
+    *, backup_name, coin, compression, compresslevel, config, config_path, output
+):
+    with zipfile.ZipFile(
+        output, compression=compression, compresslevel=compresslevel, mode="w"
+    ) as zip_fp:
+        # Backup config
+        zip_fp.write(
+            config_path, arcname=f"{backup_name}/{os.path.basename(config_path)}"
+        )
+
+        # Backup database
+        database = config["database"]["name"]
+        mysqldump_command = [
+            "mysqldump",
+            "--databases",
+            database,
+            "--host",
+            config["database"]["host"],
+            "--port",
+            str(config["database"]["port"]),
+            "--single-transaction",
+        ]
+        password = config["database"]["password"]
+        if password:
+            mysqldump_command.extend(["--password", password])
+        user = config["database"]["user"]
+        if user:
+            mysqldump_command.extend(["--user", user])
+        with subprocess.Popen(mysqldump_command, stdout=subprocess.PIPE) as process:
+            with zip_fp.open(
+                f"{backup_name}/{database}.sql", force_zip64=True, mode="w"
+            ) as database_fp:
+                copy_stream(
+                    destination=database_fp, name="database", source=process.stdout
+                )
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, "mysqldump")
+
+        # Backup wallet
+        prefix = config["coin"]["name"].lower()
+        with tempfile.NamedTemporaryFile() as wallet_fp:
+            coin.connection.backupwallet(wallet_fp.name)
+            zip_fp.write(wallet_fp.name, arcname=f"{backup_name}/{prefix}_wallet.dat")
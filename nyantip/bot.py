@@ -2,59 +2,176 @@ import logging
 import os
 import pprint
 import re
-import shutil
+import signal
 import sys
-import subprocess
-import tempfile
-import traceback
+import threading
 import time
-import zipfile
-from datetime import datetime
+import traceback
+from contextlib import contextmanager
 from decimal import Decimal
+from functools import cached_property
 
-import praw
 import yaml
-from jinja2 import Environment, PackageLoader, StrictUndefined
-from sqlalchemy import create_engine
-from prawcore.exceptions import PrawcoreException, ResponseException
 
-from . import actions, stats
+from . import backup
+from .addresses import AddressPool
+from .cluster import Cluster, default_instance_id
 from .coin import Coin
-from .const import __version__
-from .user import User
-from .util import log_function
+from .const import EXCEPTION_SLEEP_TIME, __version__
+from .failures import FailureReport
+from .ledger import Ledger
+from .profiler import SamplingProfiler
+from .rpc import CircuitOpen
+from .scheduler import RedditScheduler
+from .tracing import Tracer, tag, tracing_requestor
+from .util import ExpiringCache, LRUCache, log_function
 
 logger = logging.getLogger(__package__)
 logger.setLevel(logging.DEBUG)
 log_decorater = log_function(klass="NyanTip", log_method=logger.info)
 
-EXCEPTION_SLEEP_TIME = 60  # seconds
+HISTORY_CACHE_SIZE = 1000  # users
+INFO_BATCH_SIZE = 100  # The most `reddit.info` accepts
+PARENT_AUTHOR_CACHE_SIZE = 10000  # comments
+PARENT_AUTHOR_SECONDS = 600
+# Config sections used to set up long-lived subsystems only apply on restart
+RESTART_SECTIONS = (
+    "address_pool",
+    "cluster",
+    "database",
+    "inbox",
+    "ledger",
+    "profiler",
+    "reddit",
+    "reddit_scheduler",
+    "runtime",
+    "tracing",
+    "withdrawals",
+)
 
 
 class NyanTip:
     CONFIG_NAME = "nyantip.yml"
     PERIODIC_TASKS = {
-        "expire_pending_tips": {"period": 60},
+        "check_config": {"period": 10},
+        "expire_pending_tips": {"leader_only": True, "period": 60},
+        "flush_withdrawals": {
+            "leader_only": True,
+            "period": 10,
+            "requires": "withdrawals",
+        },
         "load_banned_users": {"period": 300},
-        "update_statistics": {"period": 900},
+        "log_reddit_usage": {"period": 600},
+        "prune_inbox": {"leader_only": True, "period": 3600},
+        "reconcile_ledger": {
+            "leader_only": True,
+            "period": 3600,
+            "requires": "ledger",
+        },
+        "replay_deferred": {"period": 30},
+        "report_failures": {"period": 60},
+        "sync_deposits": {"leader_only": True, "period": 60, "requires": "ledger"},
+        "update_statistics": {"leader_only": True, "period": 900},
     }
 
     def __init__(self):
+        self._caught_up_at = 0
+        self._reload_requested = False
         self._running = False
+        self._work = threading.local()
+        self.address_pool = None
         self.banned_users = None
         self.bot = None
+        self.cluster = None
         self.commands = []
         self.config = self.parse_config()
+        self.config_mtime = os.path.getmtime(self.config_path())
         self.database = None
         self.exception_user = None
+        self.failures = FailureReport(nyantip=self)
+        self.history_cache = LRUCache(HISTORY_CACHE_SIZE)
+        self.inbox = None
+        self.ledger = None
+        self.loop_thread = None
+        self.outbox = None
+        self.parent_authors = ExpiringCache(
+            PARENT_AUTHOR_CACHE_SIZE, PARENT_AUTHOR_SECONDS
+        )
+        self.profiler = SamplingProfiler(config=self.config.get("profiler") or {})
         self.reddit = None
-        self.templates = Environment(
+        self.reddit_scheduler = RedditScheduler(
+            config=self.config.get("reddit_scheduler") or {}
+        )
+        self.replica = None
+        self.tracer = Tracer(config=self.config.get("tracing") or {})
+        self.withdrawals = None
+
+        self.coin = Coin(config=self.config["coin"])
+        address_pool_config = self.config.get("address_pool") or {}
+        if address_pool_config.get("enabled"):
+            self.address_pool = AddressPool(config=address_pool_config, nyantip=self)
+        if (self.config.get("ledger") or {}).get("enabled"):
+            self.ledger = Ledger(coin=self.coin, nyantip=self)
+
+    @property
+    def accounts(self):
+        # Where user balances are kept: the internal ledger or the wallet accounts
+        return self.ledger or self.coin
+
+    @property
+    def read_database(self):
+        # For reporting queries that tolerate some replication lag
+        return self.replica.database() if self.replica else self.database
+
+    @cached_property
+    def templates(self):
+        from jinja2 import Environment, PackageLoader, StrictUndefined
+
+        return Environment(
             loader=PackageLoader(__package__),
             trim_blocks=True,
             undefined=StrictUndefined,
         )
 
-        self.coin = Coin(config=self.config["coin"])
+    @staticmethod
+    def compile_commands(config):
+        commands = []
+        for action, action_config in config["commands"].items():
+            if isinstance(action_config, str):
+                expression = action_config
+                command = {
+                    "action": action,
+                    "only": "message",
+                    "regex": re.compile(action_config, re.IGNORECASE | re.DOTALL),
+                }
+                command["regex"] = re.compile(expression, re.IGNORECASE | re.DOTALL)
+                logger.debug(f"ADDED REGEX for {action}: {command['regex'].pattern}")
+                commands.append(command)
+                continue
+
+            for _, option in sorted(action_config.items()):
+                expression = (
+                    option["regex"]
+                    .replace("{REGEX_ADDRESS}", config["coin"]["regex"])
+                    .replace("{REGEX_AMOUNT}", r"(\d{1,9}(?:\.\d{0,8})?)")
+                    .replace("{REGEX_KEYWORD}", f"({'|'.join(config['keywords'])})")
+                    .replace("{REGEX_USERNAME}", r"/?u/([\w-]{3,20})")
+                    .replace("{BOT_NAME}", f"/?u/{config['reddit']['username']}")
+                )
+
+                command = {
+                    "action": action,
+                    "address": option["address"],
+                    "amount": option["amount"],
+                    "destination": option["destination"],
+                    "keyword": option["keyword"],
+                    "only": option.get("only"),
+                }
+
+                command["regex"] = re.compile(expression, re.IGNORECASE | re.MULTILINE)
+                logger.debug(f"ADDED REGEX for {action}: {command['regex'].pattern}")
+                commands.append(command)
+        return commands
 
     @staticmethod
     def config_path():
@@ -78,6 +195,29 @@ class NyanTip:
         assert isinstance(container[key], str)
         container[key] = Decimal(container[key]).normalize()
 
+    @staticmethod
+    def database_url(info):
+        user = info["user"]
+        credentials = f"{user}:{info['password']}@" if user else ""
+        return f"mysql+mysqldb://{credentials}{info['host']}:{info['port']}/{info['name']}?charset=utf8mb4"
+
+    @staticmethod
+    def validate_config(config):
+        for section in ("coin", "commands", "keywords", "reddit", "sql"):
+            if not config.get(section):
+                raise Exception(f"missing config section {section}")
+        for key in ("minimum_tip", "minimum_withdraw"):
+            if config["coin"][key] <= 0:
+                raise Exception(f"coin.{key} must be positive")
+        for query in ("history", "history_older", "tips"):
+            if not config["sql"].get(query):
+                raise Exception(f"missing query sql.{query}")
+        for query in ("history", "history_older"):
+            if "LIMIT %(limit)s" not in config["sql"][query]:
+                raise Exception(
+                    f"sql.{query} must be limited by %(limit)s; copy it from the sample config"
+                )
+
     @classmethod
     def parse_config(cls):
         path = cls.config_path()
@@ -87,113 +227,160 @@ class NyanTip:
         cls.config_to_decimal(config["coin"], "minimum_tip")
         cls.config_to_decimal(config["coin"], "minimum_withdraw")
         cls.config_to_decimal(config["coin"], "transaction_fee")
+        cls.validate_config(config)
         return config
 
+    def _banned_users(self, config):
+        banned_users = set()
+        for username in config.get("banned", []):
+            banned_users.add(self.reddit.redditor(username))
+
+        subreddit = config["reddit"]["subreddit"]
+        for user in self.reddit.subreddit(subreddit).banned(limit=None):
+            banned_users.add(user)
+
+        logger.info(f"Loaded {len(banned_users)} banned user(s)")
+        return banned_users
+
+    def _request_reload(self, signum, frame):
+        # Applied between messages by `apply_pending_reload`
+        self._reload_requested = True
+
     def _run_loop(self):
         for item in self.reddit.inbox.stream(pause_after=4):
             if item is None:
-                now = time.time()
-                for task_name, task_metadata in self.PERIODIC_TASKS.items():
-                    if now >= task_metadata.setdefault(
-                        "next_run_time", now + task_metadata["period"]
-                    ):
-                        getattr(self, task_name)()
-                        now = time.time()
-                        task_metadata["next_run_time"] = now + task_metadata["period"]
+                self.inbox.mark_read()
+                self.run_periodic_tasks()
             else:
-                try:
-                    self.process_message(item)
-                except Exception:
-                    item_info = pprint.pformat(vars(item), indent=4)
-                    logger.exception(
-                        f"Exception processing the following item:\n{item_info}"
-                    )
+                self.inbox.ingest([item])
+            self.process_queue()
 
-                    if self.exception_user:
-                        message = f"Exception\n{traceback.format_exc()}\nItem:\n{item_info}".replace(
-                            "\n", "\n\n"
-                        )
-                        self.exception_user.message(
-                            message=message, subject="nyantip exception"
-                        )
+    def _run_sync(self):
+        from prawcore.exceptions import PrawcoreException
 
-                    time.sleep(60)  # Let's slow things down if there are issues
-                    continue
-                item.mark_read()
+        self.loop_thread = threading.current_thread()
+        self._running = True
+        while self._running:
+            try:
+                self._run_loop()
+            except KeyboardInterrupt:
+                self._running = False
+            except PrawcoreException:
+                logger.exception(
+                    f"PrawcoreException in runloop. Sleeping for {EXCEPTION_SLEEP_TIME} seconds."
+                )
+                time.sleep(EXCEPTION_SLEEP_TIME)
 
-    def backup(self):
-        backup_name = f"backup_nyantip_{datetime.now().strftime('%Y%m%d%H%M')}"
-        backup_passphrase = self.config["backup_passphrase"]
+    def after_commit(self, callback):
+        # Side effects outside the database wait for the unit of work to commit
+        work = getattr(self._work, "state", None)
+        if work is None:
+            callback()
+        else:
+            work["after_commit"].append(callback)
 
-        with tempfile.NamedTemporaryFile() as temp_fp:
-            with zipfile.ZipFile(temp_fp, mode="w") as zip_fp:
-                # Backup config
-                zip_fp.write(
-                    self.config_path(), arcname=f"{backup_name}/{self.CONFIG_NAME}"
-                )
+    def apply_pending_reload(self):
+        # Only the loop thread swaps the config in, never a catch-up worker in
+        # the middle of a batch that other workers are still handling
+        if self._reload_requested and threading.current_thread() is self.loop_thread:
+            self._reload_requested = False
+            try:
+                self.reload_config()
+            except Exception:  # E.g., the config file was removed
+                logger.exception("reloading the config failed")
 
-                # Backup database
-                database = self.config["database"]["name"]
-                with tempfile.NamedTemporaryFile() as database_fp:
-                    mysqldump_command = [
-                        "mysqldump",
-                        "--databases",
-                        database,
-                        "--host",
-                        self.config["database"]["host"],
-                        "--port",
-                        str(self.config["database"]["port"]),
-                        "--single-transaction",
-                    ]
-                    password = self.config["database"]["password"]
-                    if password:
-                        mysqldump_command.extend(["--password", password])
-                    user = self.config["database"]["user"]
-                    if user:
-                        mysqldump_command.extend(["--user", user])
-                    subprocess.run(mysqldump_command, check=True, stdout=database_fp)
-                    zip_fp.write(
-                        database_fp.name, arcname=f"{backup_name}/{database}.sql"
-                    )
+    def backup(self, *, compression="deflate", compresslevel=None, incremental=False):
+        self.connect_to_database()
+        if incremental:
+            return backup.backup_incremental(
+                compresslevel=compresslevel, config=self.config, database=self.database
+            )
+        return backup.backup(
+            coin=self.coin,
+            compression=compression,
+            compresslevel=compresslevel,
+            config=self.config,
+            config_path=self.config_path(),
+            database=self.database,
+        )
 
-                # Backup wallet
-                prefix = self.config["coin"]["name"].lower()
-                with tempfile.NamedTemporaryFile() as wallet_fp:
-                    self.coin.connection.backupwallet(wallet_fp.name)
-                    zip_fp.write(
-                        wallet_fp.name, arcname=f"{backup_name}/{prefix}_wallet.dat"
-                    )
+    def catch_up(self):
+        # Drains the unread backlog left by downtime, which the inbox stream
+        # only sees the newest 100 items of, before streaming resumes
+        from concurrent.futures import ThreadPoolExecutor
+
+        from .inbox import CATCH_UP_BATCH_SIZE, group_by_author
 
-            if backup_passphrase:
-                import gnupg
-
-                gpg = gnupg.GPG()
-                temp_fp.seek(0)
-                gpg.encrypt_file(
-                    temp_fp,
-                    output=f"{backup_name}.zip.gpg",
-                    passphrase=backup_passphrase,
-                    recipients=None,
-                    symmetric="AES256",
+        self._caught_up_at = time.monotonic()
+        unread = list(self.reddit.inbox.unread(limit=None))
+        for start in range(0, len(unread), CATCH_UP_BATCH_SIZE):
+            self.inbox.ingest(unread[start : start + CATCH_UP_BATCH_SIZE])
+        self.inbox.mark_read()
+        total = self.inbox.backlog()
+        if not total:
+            return
+        logger.info(f"catching up on {total} inbox item(s)")
+
+        processed = 0
+        started = time.monotonic()
+        with ThreadPoolExecutor(
+            self.inbox.catch_up_workers, thread_name_prefix="nyantip-catch-up"
+        ) as executor:
+            while True:
+                items = self.inbox.claim(limit=CATCH_UP_BATCH_SIZE)
+                if not items:
+                    break
+                for _ in executor.map(self.handle_items, group_by_author(items)):
+                    pass
+
+                processed += len(items)
+                elapsed = time.monotonic() - started
+                remaining = max(total - processed, 0)
+                logger.info(
+                    f"caught up on {processed} of {total} inbox item(s); about {remaining * elapsed / processed:.0f} seconds left"
                 )
-            else:
-                shutil.copy(temp_fp.name, f"{backup_name}.zip")
+        logger.info(
+            f"caught up on {processed} inbox item(s) in {time.monotonic() - started:.1f} seconds"
+        )
+
+    def check_config(self):
+        if os.path.getmtime(self.config_path()) != self.config_mtime:
+            self._reload_requested = True
 
     def connect_to_database(self):
+        from sqlalchemy import create_engine
+
         info = self.config["database"]
         name = info["name"]
         user = self.config["database"]["user"]
         logger.info(f"Connecting to database {name} as {user or 'anonymous'}")
 
-        credentials = f"{user}:{self.config['database']['password']}@" if user else ""
-        self.database = create_engine(
-            f"mysql+mysqldb://{credentials}{info['host']}:{info['port']}/{name}?charset=utf8mb4"
-        )
+        self.database = create_engine(self.database_url(info))
+        self.tracer.install(database=self.database)
+
+        replica = info.get("replica") or {}
+        if replica.get("host"):
+            from .replica import ReadReplica
+
+            logger.info(f"Reading reports from replica {replica['host']}")
+            # Settings left blank for the replica are the primary's
+            overrides = {key: value for key, value in replica.items() if value}
+            engine = create_engine(self.database_url({**info, **overrides}))
+            self.tracer.install(database=engine)
+            self.replica = ReadReplica(
+                config=replica, engine=engine, primary=self.database
+            )
 
     def connect_to_reddit(self):
+        import praw
+        from prawcore.exceptions import ResponseException
+
         self.reddit = praw.Reddit(
             check_for_updates=False,
             ratelimit_seconds=600,
+            requestor_class=self.reddit_scheduler.requestor(
+                tracing_requestor() if self.tracer.enabled else None
+            ),
             user_agent=f"nyantip/{__version__} by u/bboe",
             **self.config["reddit"],
         )
@@ -207,30 +394,124 @@ class NyanTip:
         if self.config["exception_user"]:
             self.exception_user = self.reddit.redditor(self.config["exception_user"])
 
+    def dead_letters(self, *, fullnames=None, redrive=False):
+        from .inbox import InboxQueue
+
+        self.connect_to_database()
+        inbox = InboxQueue(
+            config=self.config.get("inbox") or {},
+            instance_id=default_instance_id(),
+            nyantip=self,
+        )
+        if redrive:
+            redriven = inbox.redrive(fullnames)
+            print(f"queued {len(redriven)} item(s) again: {', '.join(redriven)}")
+            return
+        for row in inbox.dead_letters(fullnames):
+            print(
+                f"{row['fullname']}  {row['failed_at']}  {row['attempts']} attempt(s)"
+            )
+            if fullnames:
+                print(f"{row['payload']}\n{row['traceback']}")
+
+    def defer_reply(self, *, action, message):
+        from .user import User
+
+        response = self.templates.get_template("delayed.tpl").render(
+            action_name=action, config=self.config, message=message
+        )
+        User(name=message.author.name, nyantip=self, redditor=message.author).message(
+            body=response, message=message, subject=f"{action} delayed"
+        )
+
+    def execute(self, *args):
+        work = getattr(self._work, "state", None)
+        return (work["connection"] if work else self.database).execute(*args)
+
     @log_decorater
     def expire_pending_tips(self):
+        from . import actions
+
         pending_hours = int(self.config["pending_hours"])
 
-        for action in actions.actions(
+        for row in actions.action_rows(
             action="tip",
             created_at=f"created_at < DATE_SUB(NOW(), INTERVAL {pending_hours} HOUR)",
             nyantip=self,
             status="pending",
         ):
-            action.expire()
+            with self.user_lock(row.destination):
+                if self.cluster and not actions.check_action(
+                    message_id=row.message_id, nyantip=self, status="pending"
+                ):
+                    continue  # Accepted or declined by another instance
+                action = row.to_action(nyantip=self)
+                if action is None:
+                    continue
+                with self.unit_of_work():
+                    action.expire()
+
+    def flush_withdrawals(self):
+        self.withdrawals.flush()
+
+    def handle_item(self, item):
+        self.apply_pending_reload()
+        try:
+            with self.tracer.trace(item.fullname):
+                self.process_message(item)
+        except Exception:
+            item_info = pprint.pformat(vars(item), indent=4)
+            logger.exception(f"Exception processing the following item:\n{item_info}")
+
+            # Retry later without holding up the items behind this one
+            error = traceback.format_exc()
+            self.failures.add(error=error, name=item.fullname)
+            self.inbox.fail(item, error=error)
+            return
+        self.inbox.complete(item)
+
+    def handle_items(self, items):
+        for item in items:
+            self.handle_item(item)
+
+    def import_ledger(self):
+        if not self.ledger:
+            raise Exception("set `enabled: true` under `ledger` in the config file")
+        self.connect_to_database()
+        self.ledger.import_wallet()
+
+    def is_lagging(self, items):
+        # Whether these items reached the queue late enough to suggest the
+        # stream fell behind reddit. Ingestion time is kept through retries,
+        # deferrals, and redrives, so old items handled again don't count.
+        return (
+            bool(items)
+            and time.monotonic() - self._caught_up_at >= self.inbox.catch_up_lag_seconds
+            and max(item.ingested_utc - item.created_utc for item in items)
+            >= self.inbox.catch_up_lag_seconds
+        )
 
     def load_banned_users(self):
-        self.banned_users = set()
-        for username in self.config.get("banned", []):
-            self.banned_users.add(self.reddit.redditor(username))
+        self.banned_users = self._banned_users(self.config)
 
-        subreddit = self.config["reddit"]["subreddit"]
-        for user in self.reddit.subreddit(subreddit).banned(limit=None):
-            self.banned_users.add(user)
+    def log_reddit_usage(self):
+        self.reddit_scheduler.log_usage()
 
-        logger.info(f"Loaded {len(self.banned_users)} banned user(s)")
+    def match_command(self, *, body, message_type):
+        for command in self.commands:
+            match = command["regex"].search(body)
+            if match:
+                if command["only"] and message_type != command["only"]:
+                    logger.debug(
+                        f"ignoring {command['action']} because it's only permitted in {command['only']}"
+                    )
+                    continue
+                return command, match
+        return None, None
 
     def no_match(self, *, message, message_type):
+        from .user import User
+
         logger.info("no match")
         response = self.templates.get_template("didnt-understand.tpl").render(
             config=self.config,
@@ -243,60 +524,53 @@ class NyanTip:
             subject="What?",
         )
 
-    def prepare_commands(self):
-        for action, action_config in self.config["commands"].items():
-            if isinstance(action_config, str):
-                expression = action_config
-                command = {
-                    "action": action,
-                    "only": "message",
-                    "regex": re.compile(action_config, re.IGNORECASE | re.DOTALL),
-                }
-                command["regex"] = re.compile(expression, re.IGNORECASE | re.DOTALL)
-                logger.debug(f"ADDED REGEX for {action}: {command['regex'].pattern}")
-                self.commands.append(command)
+    def on_rollback(self, callback):
+        # Undoes a side effect outside the database if the unit of work fails.
+        # Outside a unit of work, the writes have already been committed.
+        work = getattr(self._work, "state", None)
+        if work is not None:
+            work["on_rollback"].append(callback)
+
+    def parent_author(self, comment):
+        author = self.parent_authors.get(comment.parent_id)
+        if author is None:
+            author = comment.parent().author.name
+            self.parent_authors.set(comment.parent_id, author)
+        return author
+
+    def prefetch_parent_authors(self, items):
+        # Look up the authors of the comments that parent-directed tips reply to
+        # with one request per `INFO_BATCH_SIZE` comments instead of one per tip
+        parent_ids = set()
+        for item in items:
+            if not item.was_comment or self.parent_authors.get(item.parent_id):
                 continue
+            command, match = self.match_command(body=item.body, message_type="comment")
+            if match and not any(
+                command.get(key) and match.group(command[key])
+                for key in ("address", "destination")
+            ):
+                parent_ids.add(item.parent_id)
+
+        parent_ids = sorted(parent_ids)
+        for start in range(0, len(parent_ids), INFO_BATCH_SIZE):
+            for parent in self.reddit.info(
+                fullnames=parent_ids[start : start + INFO_BATCH_SIZE]
+            ):
+                if parent.author:
+                    self.parent_authors.set(parent.fullname, parent.author.name)
 
-            for _, option in sorted(action_config.items()):
-                expression = (
-                    option["regex"]
-                    .replace("{REGEX_ADDRESS}", self.coin.config["regex"])
-                    .replace("{REGEX_AMOUNT}", r"(\d{1,9}(?:\.\d{0,8})?)")
-                    .replace(
-                        "{REGEX_KEYWORD}", f"({'|'.join(self.config['keywords'])})"
-                    )
-                    .replace("{REGEX_USERNAME}", r"/?u/([\w-]{3,20})")
-                    .replace("{BOT_NAME}", f"/?u/{self.config['reddit']['username']}")
-                )
-
-                command = {
-                    "action": action,
-                    "address": option["address"],
-                    "amount": option["amount"],
-                    "destination": option["destination"],
-                    "keyword": option["keyword"],
-                    "only": option.get("only"),
-                }
-
-                command["regex"] = re.compile(expression, re.IGNORECASE | re.MULTILINE)
-                logger.debug(f"ADDED REGEX for {action}: {command['regex'].pattern}")
-                self.commands.append(command)
+    def prepare_commands(self):
+        self.commands = self.compile_commands(self.config)
 
     def process_message(self, message):
+        from . import actions
+
         message_type = "comment" if message.was_comment else "message"
         if not message.author:
             logger.info(f"ignoring {message_type} with no author")
             return
 
-        if actions.check_action(
-            message_id=message.id,
-            nyantip=self,
-        ):
-            logger.warning(
-                "duplicate action detected (message.id %s), ignoring",
-                message.id,
-            )
-            return
         if message.author == self.config["reddit"]["username"]:
             logger.debug("ignoring message from self")
             return
@@ -304,20 +578,15 @@ class NyanTip:
             logger.info(f"ignoring message from banned user {message.author}")
             return
 
-        for command in self.commands:
-            match = command["regex"].search(message.body)
-            if match:
-                action = command["action"]
-                if command["only"] and message_type != command["only"]:
-                    logger.debug(
-                        f"ignoring {action} because it's only permitted in {command['only']}"
-                    )
-                    continue
-                break
-        else:
+        command, match = self.match_command(
+            body=message.body, message_type=message_type
+        )
+        if not match:
             logger.debug("no match found")
             self.no_match(message=message, message_type=message_type)
             return
+        action = command["action"]
+        tag(action=action)
 
         address = match.group(command["address"]) if command.get("address") else None
         amount = match.group(command["amount"]) if command.get("amount") else None
@@ -329,47 +598,222 @@ class NyanTip:
         assert not (address and destination)  # Both should never be set
         if not address and not destination:
             if message.was_comment:
-                destination = message.parent().author.name
+                destination = self.parent_author(message)
                 assert destination
 
         logger.info(f"{action} from {message.author} ({message_type} {message.id})")
         logger.debug(f"message body:\n<begin>\n{message.body}\n</end>")
-        actions.Action(
-            action=action,
-            amount=amount,
-            destination=address or destination,
-            keyword=keyword,
-            message=message,
-            nyantip=self,
-        ).perform()
+        with self.profiler.tag(action), self.user_lock(message.author.name):
+            try:
+                with self.unit_of_work():
+                    # Checked again under the lock: another instance may have
+                    # performed this item after its lease expired mid-action
+                    if actions.check_action(message_id=message.id, nyantip=self):
+                        logger.warning(
+                            f"duplicate action detected, ignoring: {message.fullname}"
+                        )
+                        return
+                    actions.Action(
+                        action=action,
+                        amount=amount,
+                        destination=address or destination,
+                        keyword=keyword,
+                        message=message,
+                        nyantip=self,
+                    ).perform()
+            except CircuitOpen:
+                # Rolled back; the item is no longer claimed, so it isn't completed
+                if self.inbox.defer(message):
+                    self.defer_reply(action=action, message=message)
+
+    def process_queue(self):
+        items = self.inbox.claim()
+        while items:
+            self.handle_items(items)
+            if self.is_lagging(items):
+                self.catch_up()
+            items = self.inbox.claim()
+
+    def prune_inbox(self):
+        self.inbox.prune()
+
+    def rebuild_stats(self, *, force=False, workers):
+        from . import stats
+
+        self.connect_to_database()
+        self.connect_to_reddit()
+        stats.rebuild_user_stats(force=force, nyantip=self, workers=workers)
+
+    def reconcile_ledger(self):
+        self.ledger.reconcile()
+
+    def reload_config(self):
+        path = self.config_path()
+        self.config_mtime = os.path.getmtime(path)
+        try:
+            config = self.parse_config()
+            commands = self.compile_commands(config)
+
+            for section in RESTART_SECTIONS:
+                if config.get(section) != self.config.get(section):
+                    logger.warning(f"changes to {section} take effect after a restart")
+                config[section] = self.config.get(section)
+            if config["coin"]["config_file"] != self.coin.config["config_file"]:
+                logger.warning(
+                    "changes to coin.config_file take effect after a restart"
+                )
+                config["coin"]["config_file"] = self.coin.config["config_file"]
+            if config["coin"].get("circuit_breaker") != self.coin.config.get(
+                "circuit_breaker"
+            ):
+                logger.warning(
+                    "changes to coin.circuit_breaker take effect after a restart"
+                )
+                config["coin"]["circuit_breaker"] = self.coin.config.get(
+                    "circuit_breaker"
+                )
+
+            # Everything that can fail is staged before anything is swapped in,
+            # and the transaction fee, the only change made outside the bot,
+            # is set last
+            banned_users = self.banned_users
+            exception_user = self.exception_user
+            if self.reddit:
+                banned_users = self._banned_users(config)
+                if config["exception_user"] != self.config["exception_user"]:
+                    exception_user = (
+                        self.reddit.redditor(config["exception_user"])
+                        if config["exception_user"]
+                        else None
+                    )
+            if config["coin"]["transaction_fee"] != self.coin.config["transaction_fee"]:
+                self.coin.connection.settxfee(config["coin"]["transaction_fee"])
+        except Exception:
+            logger.exception(f"reloading {path} failed; keeping the current config")
+            return False
+
+        self.banned_users = banned_users
+        self.coin.config = config["coin"]
+        self.coin.wallet.configure(
+            passphrase=config["coin"].get("walletpassphrase"),
+            window=float(config["coin"].get("unlock_seconds", 5)),
+        )
+        self.commands = commands
+        self.config = config
+        self.exception_user = exception_user
+        self.history_cache = LRUCache(HISTORY_CACHE_SIZE)
+        logger.info(f"reloaded {path}")
+        return True
+
+    def replay_deferred(self):
+        if self.coin.is_available():
+            self.inbox.replay_deferred()
+
+    def report_failures(self):
+        self.failures.send()
+
+    def restore_incremental(self, *, paths):
+        self.connect_to_database()
+        backup.restore_incremental(
+            config=self.config, database=self.database, paths=paths
+        )
+
+    def run(self, *, profile_seconds=None, use_asyncio=False):
+        if hasattr(signal, "SIGHUP"):  # Not available on Windows
+            signal.signal(signal.SIGHUP, self._request_reload)
+        self.profiler.install_signal_handler()
+        if profile_seconds is not None:
+            self.profiler.start(profile_seconds)
+
+        from .inbox import InboxQueue
+        from .runtime import AsyncRuntime
+        from .user import User
+        from .withdrawals import WithdrawalBatcher
 
-    def run(self):
         self.bot = User(name=self.config["reddit"]["username"], nyantip=self)
+        self.withdrawals = WithdrawalBatcher(
+            config=self.config.get("withdrawals") or {}, nyantip=self
+        )
         self.prepare_commands()
         self.connect_to_database()
         self.connect_to_reddit()
+        self.coin.set_transaction_fee()
         self.run_self_check()
 
+        cluster_config = self.config.get("cluster") or {}
+        if cluster_config.get("enabled"):
+            self.cluster = Cluster(config=cluster_config, nyantip=self)
+        self.inbox = InboxQueue(
+            config=self.config.get("inbox") or {},
+            instance_id=(
+                self.cluster.instance_id if self.cluster else default_instance_id()
+            ),
+            nyantip=self,
+        )
+        if self.cluster:
+            self.cluster.start()
+        else:
+            self.inbox.release_all()
+        if self.address_pool:
+            self.address_pool.start()
+
         # Run these tasks every start up
         self.load_banned_users()
-        self.expire_pending_tips()
+        if not self.cluster or self.cluster.is_leader:
+            if self.ledger:
+                self.sync_deposits()
+            self.expire_pending_tips()
+        self.catch_up()
 
-        logger.info(f"Bot starting v{__version__}")
-        self._running = True
-        while self._running:
-            try:
-                self._run_loop()
-            except KeyboardInterrupt:
-                self._running = False
-            except PrawcoreException:
-                logger.exception(
-                    f"PrawcoreException in runloop. Sleeping for {EXCEPTION_SLEEP_TIME} seconds."
-                )
-                time.sleep(EXCEPTION_SLEEP_TIME)
+        runtime_config = self.config.get("runtime") or {}
+        try:
+            if use_asyncio or runtime_config.get("asyncio"):
+                logger.info(f"Bot starting v{__version__} (asyncio runtime)")
+                AsyncRuntime(
+                    nyantip=self,
+                    outbound_workers=runtime_config.get("outbound_workers", 4),
+                    process_workers=runtime_config.get("process_workers", 4),
+                ).run()
+            else:
+                logger.info(f"Bot starting v{__version__}")
+                self._run_sync()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.address_pool:
+                self.address_pool.stop()
+            if self.cluster:
+                self.cluster.stop()
+            self.profiler.stop()
         logger.info(f"Bot stopped gracefully v{__version__}")
 
+    def run_periodic_tasks(self):
+        self.apply_pending_reload()
+        now = time.time()
+        for task_name, task_metadata in self.PERIODIC_TASKS.items():
+            if now >= task_metadata.setdefault(
+                "next_run_time", now + task_metadata["period"]
+            ):
+                if (
+                    not task_metadata.get("leader_only")
+                    or not self.cluster
+                    or self.cluster.is_leader
+                ) and (
+                    not task_metadata.get("requires")
+                    or getattr(self, task_metadata["requires"])
+                ):
+                    try:
+                        getattr(self, task_name)()
+                    except CircuitOpen as exception:
+                        logger.warning(f"skipped {task_name}: {exception}")
+                now = time.time()
+                task_metadata["next_run_time"] = now + task_metadata["period"]
+
     @log_decorater
     def run_self_check(self):
+        from . import actions
+        from .user import User
+
         # Ensure bot is a registered user
         if not self.bot.is_registered():
             self.bot.register()
@@ -379,25 +823,86 @@ class NyanTip:
         if balance < 0:
             raise Exception(f"negative wallet balance: {balance}")
 
+        # Ensure the wallet covers the ledger's balances
+        if self.ledger and self.ledger.reconcile() < 0:
+            raise Exception("ledger balances exceed the wallet balance")
+
         # Ensure pending tips <= bot's escrow balance
         balance = self.bot.balance(kind="tip")
-        pending_tips = sum(
-            x.amount
-            for x in actions.actions(action="tip", nyantip=self, status="pending")
-        )
+        pending_tips = actions.pending_tip_total(nyantip=self)
         if balance < pending_tips:
             raise Exception(
                 f"Bot's escrow balance ({balance}) < total pending tips ({pending_tips})"
             )
+        pending_counts = actions.pending_tip_counts(nyantip=self)
+        logger.info(
+            f"{sum(pending_counts.values())} pending tip(s) totaling {pending_tips} to {len(pending_counts)} user(s)"
+        )
 
         # Ensure user account balances are not negative
-        for row in self.database.execute(
+        for row in self.read_database.execute(
             "SELECT username FROM users ORDER BY username"
         ):
             username = row["username"]
             if User(name=username, nyantip=self).balance(kind="tip") < 0:
                 raise Exception(f"{username} has a negative balance")
 
+    def sync_deposits(self):
+        self.ledger.sync_deposits()
+
+    @contextmanager
+    def transaction(self):
+        # Within a unit of work, a savepoint keeps the block atomic on its own
+        work = getattr(self._work, "state", None)
+        if work is None:
+            with self.database.begin() as connection:
+                yield connection
+        else:
+            with work["connection"].begin_nested():
+                yield work["connection"]
+
+    @contextmanager
+    def unit_of_work(self):
+        # All database writes for one inbox item are committed together, once.
+        # Joins the unit of work already in progress on this thread, if any.
+        if getattr(self._work, "state", None) is not None:
+            yield
+            return
+
+        work = {"after_commit": [], "on_rollback": []}
+        try:
+            with self.database.begin() as connection:
+                work["connection"] = connection
+                self._work.state = work
+                try:
+                    yield
+                finally:
+                    self._work.state = None
+        except BaseException:
+            for callback in reversed(work["on_rollback"]):
+                try:
+                    callback()
+                except Exception:
+                    logger.exception(
+                        "undoing a side effect of a rolled back unit of work failed"
+                    )
+            raise
+        for callback in work["after_commit"]:
+            try:
+                callback()
+            except Exception:
+                logger.exception("a side effect of a committed unit of work failed")
+
     def update_statistics(self):
+        from . import stats
+
         stats.update_stats(nyantip=self)
         stats.update_tips(nyantip=self)
+
+    @contextmanager
+    def user_lock(self, username):
+        if self.cluster:
+            with self.cluster.user_lock(username):
+                yield
+        else:
+            yield
@@ -0,0 +1,94 @@
+import logging
+import os
+import socket
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__package__)
+
+LEADER_LEASE = "periodic"
+USER_LOCK_TIMEOUT = 30  # seconds
+
+
+# Coordinates several NyanTip processes sharing the same inbox and database.
+# Instances share the work in `inbox_queue`, whose claims are leases that a
+# heartbeat thread keeps alive, so items held by an instance that dies are taken
+# over by the survivors. A single instance holds the `periodic` lease and is the
+# only one to run the leader-only periodic tasks.
+class Cluster:
+    def __init__(self, *, config, nyantip):
+        self.heartbeat_seconds = int(config.get("heartbeat_seconds", 15))
+        self.instance_id = config.get("instance_id") or default_instance_id()
+        self.is_leader = False
+        self.nyantip = nyantip
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _heartbeat_loop(self):
+        while not self._stopped.wait(self.heartbeat_seconds):
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.exception("cluster heartbeat failed")
+
+    def elect(self):
+        result = self.nyantip.database.execute(
+            "UPDATE leases SET expires_at = NOW() + INTERVAL %s SECOND, instance_id = %s WHERE name = %s AND (instance_id = %s OR expires_at < NOW())",
+            (
+                self.nyantip.inbox.lease_seconds,
+                self.instance_id,
+                LEADER_LEASE,
+                self.instance_id,
+            ),
+        )
+        is_leader = result.rowcount == 1
+        if is_leader != self.is_leader:
+            logger.info(
+                f"instance {self.instance_id} {'is now' if is_leader else 'is no longer'} the leader"
+            )
+        self.is_leader = is_leader
+        return is_leader
+
+    def heartbeat(self):
+        self.nyantip.inbox.extend_leases()
+        self.elect()
+
+    def start(self):
+        assert self.heartbeat_seconds < self.nyantip.inbox.lease_seconds
+        logger.info(f"Joining cluster as {self.instance_id}")
+        self.nyantip.database.execute(
+            "INSERT IGNORE INTO leases (expires_at, instance_id, name) VALUES (NOW(), '', %s)",
+            LEADER_LEASE,
+        )
+        self.elect()
+        self._thread = threading.Thread(
+            daemon=True, name="nyantip-heartbeat", target=self._heartbeat_loop
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self.nyantip.database.execute(
+            "UPDATE leases SET expires_at = NOW() WHERE name = %s AND instance_id = %s",
+            (LEADER_LEASE, self.instance_id),
+        )
+        self.is_leader = False
+
+    @contextmanager
+    def user_lock(self, username):
+        # Serialize balance-affecting work for a user across instances
+        name = f"nyantip:{username.lower()}"
+        with self.nyantip.database.connect() as connection:
+            acquired = connection.execute(
+                "SELECT GET_LOCK(%s, %s)", (name, USER_LOCK_TIMEOUT)
+            ).scalar()
+            if acquired != 1:
+                raise Exception(f"timed out waiting for lock {name}")
+            try:
+                yield
+            finally:
+                connection.execute("SELECT RELEASE_LOCK(%s)", name)
+
+
+def default_instance_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
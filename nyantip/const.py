@@ -1 +1,2 @@
 __version__ = "0.8.0"
+EXCEPTION_SLEEP_TIME = 60  # seconds
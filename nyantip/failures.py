@@ -0,0 +1,58 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__package__)
+
+MAX_TRACEBACKS = 3
+MAX_TRACEBACK_LENGTH = 4000
+
+
+# Aggregates failures, e.g., of inbox items, into rate-limited reports to
+# `exception_user`.
+#
+# Failures are collected as they happen and sent as a single message at most
+# every `exception_report_seconds`, listing what failed and up to
+# `MAX_TRACEBACKS` distinct tracebacks, so a burst of failures can't flood the
+# inbox of `exception_user` or use up the reddit rate limit.
+class FailureReport:
+    def __init__(self, *, nyantip):
+        self.nyantip = nyantip
+        self._failures = []
+        self._lock = threading.Lock()
+        self._sent_at = None
+
+    def add(self, *, error, name):
+        with self._lock:
+            self._failures.append((name, error))
+
+    def send(self):
+        seconds = float(self.nyantip.config.get("exception_report_seconds", 600))
+        with self._lock:
+            now = time.monotonic()
+            if not self._failures or (
+                self._sent_at is not None and now - self._sent_at < seconds
+            ):
+                return
+            failures, self._failures = self._failures, []
+            self._sent_at = now
+
+        if not self.nyantip.exception_user:
+            return
+        tracebacks = []
+        for _, error in failures:
+            if error not in tracebacks:
+                tracebacks.append(error)
+        message = f"{len(failures)} failure(s): " + ", ".join(
+            name for name, _ in failures
+        )
+        for error in tracebacks[:MAX_TRACEBACKS]:
+            message += f"\nException\n{error[-MAX_TRACEBACK_LENGTH:]}"
+        if len(tracebacks) > MAX_TRACEBACKS:
+            message += f"\n{len(tracebacks) - MAX_TRACEBACKS} more distinct exception(s) were logged"
+        try:
+            self.nyantip.exception_user.message(
+                message=message.replace("\n", "\n\n"), subject="nyantip exceptions"
+            )
+        except Exception:
+            logger.exception("sending the failure report failed")
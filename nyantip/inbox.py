@@ -0,0 +1,343 @@
+import json
+import logging
+import threading
+import time
+import traceback
+
+from praw.models import Comment, Message, Redditor
+
+logger = logging.getLogger(__package__)
+
+CATCH_UP_BATCH_SIZE = 100
+CLAIM_BATCH_SIZE = 10
+MAX_RETRY_SECONDS = 3600
+PAYLOAD_COLUMNS = (
+    "author",
+    "body",
+    "context",
+    "created_utc",
+    "fullname",
+    "ingested_utc",
+    "kind",
+    "parent_id",
+)
+
+
+# Durable queue of raw inbox items backed by the `inbox_queue` table.
+#
+# Ingestion stores each inbox item as soon as it is seen, and items are marked
+# read on reddit in batches once they are safely stored. Processing claims
+# queued items under a lease and rebuilds praw objects from the stored columns,
+# so recovering from a crash never needs to fetch items from reddit again.
+# Leases also let several instances share the queue (see `Cluster`): items held
+# by an instance that stops heartbeating are claimed again once their lease
+# expires, up to `max_attempts` times.
+#
+# An item that fails is retried after `retry_seconds`, doubling with each
+# attempt, without holding up other items. Once it has failed `max_attempts`
+# times it is moved to the `dead_letters` table with its payload and last
+# traceback, from where `redrive` queues it again.
+#
+# Items that need the coin daemon while it is unavailable are `defer`red
+# without using up an attempt, and `replay_deferred` queues them again once
+# it has recovered.
+class InboxQueue:
+    def __init__(self, *, config, instance_id, nyantip):
+        self.batch_size = int(config.get("mark_read_batch_size", 25))
+        self.catch_up_lag_seconds = int(config.get("catch_up_lag_seconds", 300))
+        self.catch_up_workers = int(config.get("catch_up_workers", 4))
+        self.instance_id = instance_id
+        self.lease_seconds = int(config.get("lease_seconds", 60))
+        self.max_attempts = int(config.get("max_attempts", 3))
+        self.nyantip = nyantip
+        self.retry_seconds = int(config.get("retry_seconds", 30))
+        self._lock = threading.Lock()
+        self._unread = []
+
+    def _claim_rows(self, limit):
+        with self.nyantip.database.begin() as connection:
+            rows = connection.execute(
+                "SELECT * FROM inbox_queue WHERE (status = 'queued' OR (status = 'claimed' AND lease_expires_at < NOW())) AND attempts < %s ORDER BY created_utc LIMIT %s FOR UPDATE SKIP LOCKED",
+                (self.max_attempts, limit),
+            ).fetchall()
+            if not rows:
+                return []
+            fullnames = [row["fullname"] for row in rows]
+            connection.execute(
+                f"UPDATE inbox_queue SET attempts = attempts + 1, claimed_by = %s, lease_expires_at = NOW() + INTERVAL %s SECOND, status = 'claimed' WHERE fullname IN ({', '.join(['%s'] * len(fullnames))})",
+                (self.instance_id, self.lease_seconds, *fullnames),
+            )
+
+        for row in rows:
+            if row["status"] != "claimed":
+                continue
+            if row["claimed_by"]:
+                logger.info(
+                    f"reclaimed {row['fullname']} from {row['claimed_by']} (attempt {row['attempts'] + 1})"
+                )
+            else:
+                logger.info(
+                    f"retrying {row['fullname']} (attempt {row['attempts'] + 1})"
+                )
+        return rows
+
+    def _dead_letter(self, connection, *, error, row):
+        connection.execute(
+            "INSERT INTO dead_letters (attempts, fullname, payload, traceback) VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE attempts = VALUES(attempts), failed_at = NOW(), payload = VALUES(payload), traceback = VALUES(traceback)",
+            (
+                row["attempts"],
+                row["fullname"],
+                json.dumps({column: row[column] for column in PAYLOAD_COLUMNS}),
+                error,
+            ),
+        )
+        connection.execute(
+            "UPDATE inbox_queue SET claimed_by = NULL, status = 'failed' WHERE fullname = %s",
+            row["fullname"],
+        )
+        logger.error(
+            f"gave up on {row['fullname']} after {row['attempts']} attempt(s); see `nyantip dead-letters`"
+        )
+
+    def _to_item(self, row):
+        reddit = self.nyantip.reddit
+        data = {
+            "author": row["author"],
+            "body": row["body"],
+            "context": row["context"] or "",
+            "created_utc": row["created_utc"],
+            "id": row["fullname"].split("_", 1)[1],
+            "ingested_utc": row["ingested_utc"],
+            "parent_id": row["parent_id"],
+            "was_comment": row["kind"] == "comment",
+        }
+        if row["kind"] == "comment":
+            # Converts `author` to a Redditor, or None for reddit's "[deleted]"
+            data["author"] = data["author"] or "[deleted]"
+            return Comment(reddit, _data=data)
+        if data["author"]:
+            data["author"] = Redditor(reddit, data["author"])
+        return Message(reddit, _data=data)
+
+    def _without_duplicates(self, items):
+        # Items whose action was saved before their queue row was completed,
+        # e.g., when interrupted, are found with one query per claimed batch
+        if not items:
+            return items
+        done = {
+            row["message_id"]
+            for row in self.nyantip.database.execute(
+                f"SELECT message_id FROM actions WHERE message_id IN ({', '.join(['%s'] * len(items))})",
+                [item.id for item in items],
+            )
+        }
+        if not done:
+            return items
+        duplicates = [item.fullname for item in items if item.id in done]
+        logger.warning(
+            f"duplicate action(s) detected, ignoring: {', '.join(duplicates)}"
+        )
+        self.nyantip.database.execute(
+            f"UPDATE inbox_queue SET claimed_by = NULL, status = 'completed' WHERE claimed_by = %s AND fullname IN ({', '.join(['%s'] * len(duplicates))})",
+            (self.instance_id, *duplicates),
+        )
+        return [item for item in items if item.id not in done]
+
+    def backlog(self):
+        return self.nyantip.database.execute(
+            "SELECT COUNT(*) FROM inbox_queue WHERE (status = 'queued' OR (status = 'claimed' AND lease_expires_at < NOW())) AND attempts < %s",
+            self.max_attempts,
+        ).scalar_one()
+
+    def claim(self, *, limit=CLAIM_BATCH_SIZE):
+        items = []
+        while not items:
+            rows = self._claim_rows(limit)
+            if not rows:
+                return []
+            items = []
+            for row in rows:
+                try:
+                    items.append(self._to_item(row))
+                except Exception:
+                    logger.exception(f"loading {row['fullname']} failed")
+                    with self.nyantip.database.begin() as connection:
+                        self._dead_letter(
+                            connection, error=traceback.format_exc(), row=row
+                        )
+            items = self._without_duplicates(items)
+        try:
+            self.nyantip.prefetch_parent_authors(items)
+        except Exception:  # Each parent is then fetched when its item is processed
+            logger.exception("prefetching parent comments failed")
+        return items
+
+    def complete(self, item):
+        self.nyantip.database.execute(
+            "UPDATE inbox_queue SET claimed_by = NULL, status = 'completed' WHERE fullname = %s AND claimed_by = %s",
+            (item.fullname, self.instance_id),
+        )
+
+    def dead_letters(self, fullnames=None):
+        where = (
+            f" WHERE fullname IN ({', '.join(['%s'] * len(fullnames))})"
+            if fullnames
+            else ""
+        )
+        return self.nyantip.database.execute(
+            f"SELECT * FROM dead_letters{where} ORDER BY failed_at", fullnames or []
+        ).fetchall()
+
+    def defer(self, item):
+        # Returns whether the item wasn't deferred before
+        with self.nyantip.database.begin() as connection:
+            row = connection.execute(
+                "SELECT deferred_at FROM inbox_queue WHERE fullname = %s AND claimed_by = %s FOR UPDATE",
+                (item.fullname, self.instance_id),
+            ).first()
+            if row is None:  # Taken over by another instance
+                return False
+            connection.execute(
+                "UPDATE inbox_queue SET attempts = attempts - 1, claimed_by = NULL, deferred_at = COALESCE(deferred_at, NOW()), status = 'deferred' WHERE fullname = %s",
+                item.fullname,
+            )
+        logger.info(f"deferred {item.fullname} until the coin daemon is available")
+        return row["deferred_at"] is None
+
+    def extend_leases(self):
+        self.nyantip.database.execute(
+            "UPDATE inbox_queue SET lease_expires_at = NOW() + INTERVAL %s SECOND WHERE claimed_by = %s AND status = 'claimed'",
+            (self.lease_seconds, self.instance_id),
+        )
+
+    def fail(self, item, *, error):
+        with self.nyantip.database.begin() as connection:
+            row = connection.execute(
+                "SELECT * FROM inbox_queue WHERE fullname = %s AND claimed_by = %s FOR UPDATE",
+                (item.fullname, self.instance_id),
+            ).first()
+            if row is None:  # Taken over by another instance
+                return
+            if row["attempts"] >= self.max_attempts:
+                self._dead_letter(connection, error=error, row=row)
+                return
+
+            delay = min(
+                self.retry_seconds * 2 ** max(row["attempts"] - 1, 0),
+                MAX_RETRY_SECONDS,
+            )
+            connection.execute(
+                "UPDATE inbox_queue SET claimed_by = NULL, lease_expires_at = NOW() + INTERVAL %s SECOND WHERE fullname = %s",
+                (delay, item.fullname),
+            )
+        logger.info(
+            f"retrying {item.fullname} in {delay} seconds ({row['attempts']} of {self.max_attempts} attempt(s) failed)"
+        )
+
+    def ingest(self, items):
+        now = int(time.time())
+        values = []
+        for item in items:
+            is_comment = isinstance(item, Comment) or item.was_comment
+            values.extend(
+                [
+                    item.author.name if item.author else None,
+                    item.body,
+                    getattr(item, "context", None) or None,
+                    int(item.created_utc),
+                    item.fullname,
+                    now,
+                    "comment" if is_comment else "message",
+                    getattr(item, "parent_id", None),
+                ]
+            )
+        self.nyantip.database.execute(
+            f"INSERT IGNORE INTO inbox_queue (author, body, context, created_utc, fullname, ingested_utc, kind, parent_id) VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * len(items))}",
+            values,
+        )
+        logger.debug(f"ingested {len(items)} inbox item(s)")
+
+        with self._lock:
+            self._unread.extend(items)
+            full = len(self._unread) >= self.batch_size
+        if full:
+            self.mark_read()
+
+    def mark_read(self):
+        # Ingestion and catch-up run on different threads, so each call takes
+        # the pending items for itself and puts them back if marking fails
+        with self._lock:
+            unread, self._unread = self._unread, []
+        if not unread:
+            return
+        try:
+            self.nyantip.reddit.inbox.mark_read(unread)
+        except Exception:
+            with self._lock:
+                self._unread[:0] = unread
+            raise
+        logger.debug(f"marked {len(unread)} inbox item(s) read")
+
+    def prune(self):
+        # Items whose last attempt was cut short, e.g., by a crash
+        with self.nyantip.database.begin() as connection:
+            for row in connection.execute(
+                "SELECT * FROM inbox_queue WHERE status = 'claimed' AND lease_expires_at < NOW() AND attempts >= %s FOR UPDATE SKIP LOCKED",
+                self.max_attempts,
+            ).fetchall():
+                self._dead_letter(
+                    connection,
+                    error=f"lease held by {row['claimed_by']} expired",
+                    row=row,
+                )
+        self.nyantip.database.execute(
+            "DELETE FROM inbox_queue WHERE status = 'completed' AND created_utc < UNIX_TIMESTAMP(NOW() - INTERVAL 7 DAY)"
+        )
+
+    def redrive(self, fullnames=None):
+        # Queue dead letters again with a fresh set of attempts
+        with self.nyantip.database.begin() as connection:
+            where = (
+                f" WHERE fullname IN ({', '.join(['%s'] * len(fullnames))})"
+                if fullnames
+                else ""
+            )
+            rows = connection.execute(
+                f"SELECT fullname, payload FROM dead_letters{where} FOR UPDATE",
+                fullnames or [],
+            ).fetchall()
+            for row in rows:
+                payload = json.loads(row["payload"])
+                connection.execute(
+                    "INSERT INTO inbox_queue (author, body, context, created_utc, fullname, ingested_utc, kind, parent_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE attempts = 0, claimed_by = NULL, lease_expires_at = NULL, status = 'queued'",
+                    [payload[column] for column in PAYLOAD_COLUMNS],
+                )
+                connection.execute(
+                    "DELETE FROM dead_letters WHERE fullname = %s", row["fullname"]
+                )
+        return [row["fullname"] for row in rows]
+
+    def release_all(self):
+        # Only safe when no other instance shares the queue
+        result = self.nyantip.database.execute(
+            "UPDATE inbox_queue SET claimed_by = NULL, lease_expires_at = NOW() WHERE status = 'claimed' AND claimed_by IS NOT NULL"
+        )
+        if result.rowcount > 0:
+            logger.info(f"recovered {result.rowcount} interrupted inbox item(s)")
+
+    def replay_deferred(self):
+        result = self.nyantip.database.execute(
+            "UPDATE inbox_queue SET status = 'queued' WHERE status = 'deferred'"
+        )
+        if result.rowcount > 0:
+            logger.info(f"replaying {result.rowcount} deferred inbox item(s)")
+
+
+def group_by_author(items):
+    # Each author's items have to be handled in order, but authors are
+    # independent of each other and can be handled in parallel
+    groups = {}
+    for item in items:
+        author = item.author.name.lower() if item.author else None
+        groups.setdefault(author, []).append(item)
+    return list(groups.values())
@@ -0,0 +1,226 @@
+import logging
+import uuid
+from decimal import Decimal
+
+from .util import log_function
+
+logger = logging.getLogger(__package__)
+
+DEPOSITS_ACCOUNT = "@deposits"
+IMPORT_ACCOUNT = "@import"
+SENT_ACCOUNT = "@sent"
+WITHDRAWALS_ACCOUNT = "@withdrawals"
+
+
+# Double-entry ledger of user balances kept in MySQL.
+#
+# Every movement of funds is a journal of `ledger_entries` rows whose amounts
+# sum to zero, and `ledger_balances` caches the running total of each account
+# in the same transaction. Accounts starting with `@` are system accounts that
+# stand in for the wallet. A tip is therefore a single database transaction;
+# the wallet is only used to detect deposits in bulk with `listsinceblock` and
+# to pay withdrawals out of its pooled balance. Credited deposits that have not
+# yet reached a higher `minconf` are held back from that balance, so withdrawals
+# keep requiring more confirmations than tips. Sent withdrawals are posted from
+# `@withdrawals` to `@sent`, which stands in for everything paid out.
+class Ledger:
+    def __init__(self, *, coin, nyantip):
+        self.coin = coin
+        self.nyantip = nyantip
+
+    @staticmethod
+    def _post(connection, *, entries, kind, reference=None):
+        assert sum(amount for _, amount in entries) == 0
+        # Update balances in a consistent order so concurrent journals can't deadlock
+        entries = sorted(entries)
+        journal_id = uuid.uuid4().hex
+        connection.execute(
+            f"INSERT INTO ledger_entries (account, amount, journal_id, kind, reference) VALUES {', '.join(['(%s, %s, %s, %s, %s)'] * len(entries))}",
+            [
+                value
+                for account, amount in entries
+                for value in (account, amount, journal_id, kind, reference)
+            ],
+        )
+        connection.execute(
+            f"INSERT INTO ledger_balances (balance, username) VALUES {', '.join(['(%s, %s)'] * len(entries))} ON DUPLICATE KEY UPDATE balance = balance + VALUES(balance)",
+            [value for account, amount in entries for value in (amount, account)],
+        )
+        return journal_id
+
+    def balance(self, *, minconf, user):
+        balance = self.nyantip.execute(
+            "SELECT COALESCE((SELECT balance FROM ledger_balances WHERE username = %s), 0) - COALESCE((SELECT SUM(amount) FROM deposits WHERE username = %s AND credited_at IS NOT NULL AND confirmations < %s), 0)",
+            (user, user, minconf),
+        ).scalar_one()
+        return Decimal(balance).normalize()
+
+    @log_function(klass="Ledger")
+    def import_wallet(self):
+        database = self.nyantip.database
+        if database.execute("SELECT 1 FROM ledger_entries LIMIT 1").one_or_none():
+            raise Exception("the ledger already contains entries")
+
+        # Import balances with enough confirmations to withdraw, and let
+        # `sync_deposits` credit everything more recent than that.
+        connection = self.coin.connection
+        minconf = self.coin.config["minconf"]["withdraw"]
+        while True:
+            block_count = connection.getblockcount()
+            accounts = connection.listaccounts(minconf)
+            if connection.getblockcount() == block_count:
+                break
+        last_block = connection.getblockhash(max(block_count - minconf + 1, 0))
+
+        usernames = {
+            row["username"] for row in database.execute("SELECT username FROM users")
+        }
+        entries = [
+            (account, amount)
+            for account, amount in accounts.items()
+            if account in usernames and amount
+        ]
+        total = sum(amount for _, amount in entries)
+        with database.begin() as transaction:
+            if entries:
+                self._post(
+                    transaction,
+                    entries=[*entries, (IMPORT_ACCOUNT, -total)],
+                    kind="import",
+                )
+            transaction.execute(
+                "INSERT INTO ledger_state (name, value) VALUES ('last_block', %s)",
+                last_block,
+            )
+        logger.info(f"imported {total} from {len(entries)} wallet account(s)")
+
+    @log_function(klass="Ledger", log_response=True)
+    def reconcile(self):
+        # Users' balances plus the withdrawals held in `@withdrawals` until sent
+        liabilities = self.nyantip.database.execute(
+            "SELECT (SELECT COALESCE(SUM(balance), 0) FROM ledger_balances WHERE LEFT(username, 1) <> '@') + (SELECT COALESCE(SUM(amount), 0) FROM actions WHERE action = 'withdraw' AND status IN ('pending', 'sending'))"
+        ).scalar_one()
+        wallet = self.coin.connection.getbalance(
+            "*", self.coin.config["minconf"]["tip"]
+        )
+        difference = wallet - liabilities
+        if difference < 0:
+            logger.error(
+                f"ledger balances ({liabilities}) exceed the wallet balance ({wallet})"
+            )
+        else:
+            logger.info(f"wallet balance exceeds ledger balances by {difference}")
+        return difference
+
+    @log_function("amount", "destination", "source", klass="Ledger")
+    def send(self, *, amount, destination, source):
+        with self.nyantip.transaction() as connection:
+            self._post(
+                connection,
+                entries=[(destination.name, amount), (source.name, -amount)],
+                kind="transfer",
+            )
+
+    @log_function("amounts", "source", klass="Ledger", log_response=True)
+    def send_many(self, *, amounts, source):
+        # The ledger already holds the funds in `source`. The wallet's account
+        # balances are meaningless once the ledger is enabled, but `sendmany`
+        # still requires the account it sends from to cover the total.
+        total = sum(amounts.values())
+        self.coin.connection.move("", source, total)
+        try:
+            return self.coin.send_many(amounts=amounts, source=source)
+        except Exception:
+            self.coin.connection.move(source, "", total)
+            raise
+
+    @log_function(klass="Ledger")
+    def sync_deposits(self):
+        minconf = self.coin.config["minconf"]
+        last_block = self.nyantip.database.execute(
+            "SELECT value FROM ledger_state WHERE name = 'last_block'"
+        ).scalar_one_or_none()
+        if last_block is None:
+            raise Exception("the ledger is empty; run `nyantip ledger-import` first")
+
+        # Transactions with fewer than `minconf.withdraw` confirmations are listed
+        # again on the next call, which keeps their confirmation counts current.
+        result = self.coin.connection.listsinceblock(last_block, minconf["withdraw"])
+        received = {}
+        for transaction in result["transactions"]:
+            if transaction["category"] != "receive":
+                continue
+            key = (transaction["txid"], transaction["address"])
+            amount, _ = received.get(key, (0, None))
+            received[key] = (
+                amount + transaction["amount"],
+                transaction["confirmations"],
+            )
+
+        with self.nyantip.database.begin() as connection:
+            usernames = {}
+            if received:
+                addresses = sorted({address for _, address in received})
+                usernames = dict(
+                    connection.execute(
+                        f"SELECT address, username FROM users WHERE address IN ({', '.join(['%s'] * len(addresses))})",
+                        addresses,
+                    ).fetchall()
+                )
+            values = []
+            for (txid, address), (amount, confirmations) in sorted(received.items()):
+                if address in usernames:
+                    values.extend(
+                        [address, amount, confirmations, txid, usernames[address]]
+                    )
+            if values:
+                connection.execute(
+                    f"INSERT INTO deposits (address, amount, confirmations, txid, username) VALUES {', '.join(['(%s, %s, %s, %s, %s)'] * (len(values) // 5))} ON DUPLICATE KEY UPDATE confirmations = VALUES(confirmations)",
+                    values,
+                )
+
+            # Deposits that were not listed again have reached `minconf.withdraw`
+            for row in connection.execute(
+                "SELECT address, txid FROM deposits WHERE confirmations < %s",
+                minconf["withdraw"],
+            ).fetchall():
+                if (row["txid"], row["address"]) not in received:
+                    connection.execute(
+                        "UPDATE deposits SET confirmations = %s WHERE address = %s AND txid = %s",
+                        (minconf["withdraw"], row["address"], row["txid"]),
+                    )
+
+            deposits = connection.execute(
+                "SELECT address, amount, txid, username FROM deposits WHERE credited_at IS NULL AND confirmations >= %s FOR UPDATE",
+                minconf["tip"],
+            ).fetchall()
+            for deposit in deposits:
+                self._post(
+                    connection,
+                    entries=[
+                        (DEPOSITS_ACCOUNT, -deposit["amount"]),
+                        (deposit["username"], deposit["amount"]),
+                    ],
+                    kind="deposit",
+                    reference=deposit["txid"],
+                )
+                connection.execute(
+                    "UPDATE deposits SET credited_at = NOW() WHERE address = %s AND txid = %s",
+                    (deposit["address"], deposit["txid"]),
+                )
+            connection.execute(
+                "UPDATE ledger_state SET value = %s WHERE name = 'last_block'",
+                result["lastblock"],
+            )
+        if deposits:
+            logger.info(f"credited {len(deposits)} deposit(s)")
+
+    @log_function("amount", "source", "transaction_id", klass="Ledger")
+    def withdraw(self, *, amount, source, transaction_id):
+        with self.nyantip.transaction() as connection:
+            self._post(
+                connection,
+                entries=[(SENT_ACCOUNT, amount), (source.name, -amount)],
+                kind="withdraw",
+                reference=transaction_id,
+            )
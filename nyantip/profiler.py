@@ -0,0 +1,121 @@
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__package__)
+
+
+# Low-overhead wall-clock sampling profiler that can be toggled while running.
+#
+# While active, a background thread snapshots the stack of every other thread
+# each `interval_ms` and counts identical stacks. The result is written in the
+# collapsed format understood by flamegraph.pl and speedscope. Each stack is
+# rooted at its thread's name and, while an action is being processed, at the
+# action's type (e.g., `action:tip`), so time can be broken down per action.
+# Sending SIGUSR1 to the process starts a capture of `seconds` seconds, or
+# stops a running one early.
+class SamplingProfiler:
+    def __init__(self, *, config):
+        self.directory = config.get("directory") or "."
+        self.interval = float(config.get("interval_ms", 5)) / 1000
+        self.seconds = float(config.get("seconds", 30))
+        self._actions = Counter()
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._stopped = threading.Event()
+        self._tags = {}
+        self._thread = None
+
+    def _handle_signal(self, signum, frame):
+        if self.is_running():
+            self.stop()
+        else:
+            self.start()
+
+    def _run(self, seconds):
+        started = time.monotonic()
+        samples = 0
+        while (
+            not self._stopped.wait(self.interval)
+            and time.monotonic() - started < seconds
+        ):
+            self.sample()
+            samples += 1
+        path = self.write(duration=time.monotonic() - started, samples=samples)
+        logger.info(f"profile written to {path}")
+
+    def install_signal_handler(self):
+        if hasattr(signal, "SIGUSR1"):  # Not available on Windows
+            signal.signal(signal.SIGUSR1, self._handle_signal)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            stack.append(f"thread:{names.get(thread_id, thread_id)}")
+            tag = self._tags.get(thread_id)
+            if tag:
+                stack.append(f"action:{tag}")
+            self._stacks[";".join(reversed(stack))] += 1
+
+    def start(self, seconds=None):
+        with self._lock:
+            if self.is_running():
+                return
+            self._actions.clear()
+            self._stacks.clear()
+            self._stopped.clear()
+            seconds = seconds or self.seconds
+            logger.info(f"profiling for {seconds:g} seconds")
+            self._thread = threading.Thread(
+                args=(seconds,), daemon=True, name="nyantip-profiler", target=self._run
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    @contextmanager
+    def tag(self, action):
+        thread_id = threading.get_ident()
+        self._tags[thread_id] = action
+        if self.is_running():
+            self._actions[action] += 1
+        try:
+            yield
+        finally:
+            self._tags.pop(thread_id, None)
+
+    def write(self, *, duration, samples):
+        path = os.path.join(
+            self.directory,
+            f"profile_nyantip_{datetime.now().strftime('%Y%m%d%H%M%S')}.collapsed",
+        )
+        with open(path, "w") as fp:
+            for stack, count in self._stacks.most_common():
+                fp.write(f"{stack} {count}\n")
+        actions = ", ".join(
+            f"{action}={count}" for action, count in sorted(self._actions.items())
+        )
+        logger.info(
+            f"profiled {samples} sample(s) over {duration:.1f} seconds; actions: {actions or 'none'}"
+        )
+        return path
@@ -0,0 +1,62 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__package__)
+
+CHECK_INTERVAL = 10  # seconds
+
+
+# Routes reporting queries to a MySQL read replica.
+#
+# Statistics, wiki pages, and history are read from the replica while its
+# replication lag is at most `max_lag_seconds`. The lag is checked at most every
+# `CHECK_INTERVAL` seconds, and reads fall back to the primary while the replica
+# lags further behind, has stopped replicating, or can't be reached. Writes and
+# the reads that balances and duplicate detection depend on always use the
+# primary.
+class ReadReplica:
+    def __init__(self, *, config, engine, primary):
+        self.engine = engine
+        self.max_lag_seconds = float(config.get("max_lag_seconds", 30))
+        self.primary = primary
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self._usable = False
+
+    def database(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at >= CHECK_INTERVAL:
+                self._checked_at = now
+                usable = self.is_usable()
+                if usable != self._usable:
+                    log = logger.info if usable else logger.warning
+                    log(f"reading from the {'replica' if usable else 'primary'}")
+                self._usable = usable
+        return self.engine if self._usable else self.primary
+
+    def is_usable(self):
+        try:
+            lag = self.lag()
+        except Exception:
+            logger.exception("checking the replica failed")
+            return False
+        if lag is None:
+            logger.warning("the replica is not replicating")
+            return False
+        if lag > self.max_lag_seconds:
+            logger.warning(f"the replica is {lag} second(s) behind")
+            return False
+        return True
+
+    def lag(self):
+        # `SHOW REPLICA STATUS` needs MySQL 8.0.22 or MariaDB 10.5.1
+        try:
+            row = self.engine.execute("SHOW REPLICA STATUS").first()
+        except Exception:
+            row = self.engine.execute("SHOW SLAVE STATUS").first()
+        if row is None:
+            return None
+        row = dict(row)
+        return row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
@@ -1,21 +1,137 @@
+import logging
+import threading
+import time
+from collections import deque
+from http.client import HTTPException
+
 from bitcoinrpc.authproxy import AuthServiceProxy
 
+from .tracing import span
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_TIMEOUT = 30  # seconds
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+# Stops calling the coin daemon while it is down or too slow to be useful.
+#
+# Every RPC call is recorded as failed if it couldn't reach the daemon or took
+# longer than `slow_call_ms`. Once at least `minimum_calls` were made within the
+# last `window_seconds` and `error_rate` of them failed, the circuit opens, and
+# calls raise `CircuitOpen` right away instead of waiting on a timeout. After
+# `open_seconds` a single probing call is let through (half-open). If it
+# succeeds the circuit closes again, otherwise it stays open for another
+# `open_seconds`.
+class CircuitBreaker:
+    def __init__(self, *, config):
+        self.error_rate = float(config.get("error_rate", 0.5))
+        self.minimum_calls = int(config.get("minimum_calls", 5))
+        self.open_seconds = float(config.get("open_seconds", 30))
+        self.slow_call_seconds = float(config.get("slow_call_ms", 5000)) / 1000
+        self.state = "closed"
+        self.timeout_seconds = float(config.get("timeout_seconds", DEFAULT_TIMEOUT))
+        self.window_seconds = float(config.get("window_seconds", 60))
+        self._calls = deque()
+        self._lock = threading.Lock()
+        self._opened_at = None
 
-def close_connection(connection, function_name):
+    def _open(self, now):
+        self.state = "open"
+        self._opened_at = now
+        logger.warning(f"coin daemon circuit opened for {self.open_seconds:g} seconds")
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            waited = time.monotonic() - self._opened_at
+            if self.state == "open" and waited >= self.open_seconds:
+                self.state = "half_open"
+                logger.info("probing the coin daemon")
+                return
+            raise CircuitOpen(
+                f"the coin daemon is unavailable (circuit {self.state.replace('_', '-')} for {waited:.0f} seconds)"
+            )
+
+    def is_closed(self):
+        return self.state == "closed"
+
+    def record(self, *, failed, seconds):
+        failed = failed or seconds > self.slow_call_seconds
+        now = time.monotonic()
+        with self._lock:
+            if self.state == "half_open":
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = "closed"
+                    self._calls.clear()
+                    logger.info("the coin daemon recovered; circuit closed")
+                return
+            if self.state == "open":  # A call made before the circuit opened
+                return
+
+            self._calls.append((now, failed))
+            while self._calls[0][0] < now - self.window_seconds:
+                self._calls.popleft()
+            failures = sum(call_failed for _, call_failed in self._calls)
+            if len(
+                self._calls
+            ) >= self.minimum_calls and failures >= self.error_rate * len(self._calls):
+                logger.warning(
+                    f"{failures} of {len(self._calls)} coin daemon call(s) failed or were slow"
+                )
+                self._open(now)
+
+
+def close_connection(connection, function_name, breaker=None):
     function = getattr(connection, function_name)
 
     def wrapped(*args, **kwargs):
+        if breaker:
+            breaker.before_call()
+        failed = False
+        started = time.monotonic()
         try:
-            return function(*args, **kwargs)
+            with span("rpc", function_name):
+                return function(*args, **kwargs)
+        except (HTTPException, OSError):  # Includes timeouts and refused connections
+            failed = True
+            raise
         finally:
             connection._AuthServiceProxy__conn.close()
+            if breaker:
+                breaker.record(failed=failed, seconds=time.monotonic() - started)
 
     return wrapped
 
 
 class Rpc:
-    def __init__(self, url):
-        self._connection = AuthServiceProxy(url)
+    def __init__(self, url, *, breaker=None):
+        self.breaker = breaker
+        self._local = threading.local()
+        self._url = url
 
     def __getattr__(self, attribute):
-        return close_connection(connection=self._connection, function_name=attribute)
+        return close_connection(
+            breaker=self.breaker,
+            connection=self._connection,
+            function_name=attribute,
+        )
+
+    @property
+    def _connection(self):
+        # AuthServiceProxy isn't thread-safe, so each thread uses its own
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = AuthServiceProxy(
+                self._url,
+                timeout=self.breaker.timeout_seconds
+                if self.breaker
+                else DEFAULT_TIMEOUT,
+            )
+        return connection
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from prawcore.exceptions import PrawcoreException
+
+from .const import EXCEPTION_SLEEP_TIME
+from .inbox import group_by_author
+
+logger = logging.getLogger(__package__)
+
+PERIODIC_CHECK_INTERVAL = 5  # seconds
+
+
+# Inbox ingestion, message processing, periodic tasks, and outbound reddit calls
+# run as cooperating asyncio tasks, so ingestion into `inbox_queue` can run
+# ahead of processing. Each claimed batch is split by author, and up to
+# `process_workers` authors are handled at once, each author's items in order,
+# the same way `catch_up` drains a backlog. Periodic tasks and config reloads
+# run on a single control lane, and only between batches.
+#
+# Action logic is shared with the synchronous runtime, so the reddit, coin
+# daemon, and database clients stay synchronous (praw, bitcoinrpc, and
+# SQLAlchemy) and are driven from small dedicated executors; async client
+# libraries are not used, so every blocking call still occupies an executor
+# thread while it waits.
+class AsyncRuntime:
+    def __init__(self, *, nyantip, outbound_workers, process_workers):
+        self.nyantip = nyantip
+        self._batch = None
+        self._control_executor = ThreadPoolExecutor(
+            1, thread_name_prefix="nyantip-control"
+        )
+        self._ingest_executor = ThreadPoolExecutor(
+            1, thread_name_prefix="nyantip-ingest"
+        )
+        self._loop = None
+        self._outbound_executor = ThreadPoolExecutor(
+            outbound_workers, thread_name_prefix="nyantip-outbound"
+        )
+        self._process_executor = ThreadPoolExecutor(
+            process_workers, thread_name_prefix="nyantip-process"
+        )
+        self._queued = None
+
+    @staticmethod
+    def _deliver(function):
+        try:
+            function()
+        except Exception:
+            logger.exception("outbound reddit call failed")
+
+    async def _ingest(self):
+        while True:
+            stream = self.nyantip.reddit.inbox.stream(pause_after=4)
+            try:
+                while True:
+                    item = await self._loop.run_in_executor(
+                        self._ingest_executor, next, stream
+                    )
+                    if item is None:
+                        await self._loop.run_in_executor(
+                            self._ingest_executor, self.nyantip.inbox.mark_read
+                        )
+                        continue
+                    await self._loop.run_in_executor(
+                        self._ingest_executor, self.nyantip.inbox.ingest, [item]
+                    )
+                    self._queued.set()
+            except PrawcoreException:
+                logger.exception(
+                    f"PrawcoreException in ingest task. Sleeping for {EXCEPTION_SLEEP_TIME} seconds."
+                )
+                await asyncio.sleep(EXCEPTION_SLEEP_TIME)
+
+    async def _periodic(self):
+        while True:
+            await asyncio.sleep(PERIODIC_CHECK_INTERVAL)
+            async with self._batch:
+                await self._loop.run_in_executor(
+                    self._control_executor, self.nyantip.run_periodic_tasks
+                )
+
+    async def _process(self):
+        while True:
+            self._queued.clear()
+            items = await self._loop.run_in_executor(
+                self._control_executor, self.nyantip.inbox.claim
+            )
+            if not items:
+                try:
+                    await asyncio.wait_for(self._queued.wait(), PERIODIC_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            async with self._batch:
+                await asyncio.gather(
+                    *(
+                        self._loop.run_in_executor(
+                            self._process_executor, self.nyantip.handle_items, group
+                        )
+                        for group in group_by_author(items)
+                    )
+                )
+                if self.nyantip.is_lagging(items):
+                    await self._loop.run_in_executor(
+                        self._control_executor, self.nyantip.catch_up
+                    )
+
+    def outbox(self, function):
+        self._outbound_executor.submit(self._deliver, function)
+
+    def run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._batch = asyncio.Lock()
+        self._queued = asyncio.Event()
+        self.nyantip.loop_thread = self._control_executor.submit(
+            threading.current_thread
+        ).result()
+        self.nyantip.outbox = self.outbox
+        tasks = [
+            self._loop.create_task(coroutine)
+            for coroutine in (self._ingest(), self._periodic(), self._process())
+        ]
+        main = asyncio.gather(*tasks)
+        try:
+            self._loop.run_until_complete(main)
+        finally:
+            main.cancel()
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(
+                asyncio.gather(main, *tasks, return_exceptions=True)
+            )
+            self.nyantip.outbox = None
+            self._process_executor.shutdown(wait=True)
+            self._control_executor.shutdown(wait=True)
+            logger.info("waiting for outbound messages to be sent")
+            self._outbound_executor.shutdown(wait=True)
+            self._ingest_executor.shutdown(wait=False)
+            self._loop.close()
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__package__)
+
+# In priority order
+CATEGORIES = ("inbox", "replies", "lookups", "stats")
+DEFAULT_RESERVES = {"inbox": 0, "lookups": 15, "replies": 5, "stats": 30}
+INBOX_PATHS = (
+    "/api/read_all_messages",
+    "/api/read_message",
+    "/api/unread_message",
+    "/message/",
+)
+REPLY_PATHS = ("/api/comment", "/api/compose")
+
+
+class RequestDropped(Exception):
+    pass
+
+
+# Shares reddit's API rate limit between the bot's kinds of requests.
+#
+# Every request praw makes passes through `requestor`, which classifies it by
+# endpoint as `inbox`, `replies`, `lookups`, or `stats` (wiki pages) and tracks
+# the remaining budget from reddit's `x-ratelimit-*` response headers. A request
+# is only sent while more than its category's `reserve` requests remain in the
+# current window, which keeps the end of the budget for higher priorities.
+# Below that, replies and lookups wait for the window to reset, while stats
+# requests are dropped with `RequestDropped` unless the thread is `deferring`.
+class RedditScheduler:
+    def __init__(self, *, config):
+        self.remaining = None
+        self.reserves = {**DEFAULT_RESERVES, **(config.get("reserve") or {})}
+        self._condition = threading.Condition()
+        self._dropped = Counter()
+        self._local = threading.local()
+        self._reset_at = None
+        self._used = Counter()
+
+    @staticmethod
+    def classify(method, url):
+        path = urlparse(url).path
+        if path.startswith(INBOX_PATHS):
+            return "inbox"
+        if method.upper() == "POST" and path.startswith(REPLY_PATHS):
+            return "replies"
+        if "/wiki/" in path:
+            return "stats"
+        return "lookups"
+
+    def admit(self, category):
+        reserve = self.reserves[category]
+        with self._condition:
+            while self.remaining is not None and self.remaining <= reserve:
+                wait = self._reset_at - time.monotonic()
+                if wait <= 0:  # A new window has started
+                    self.remaining = None
+                    break
+                if category == "stats" and not getattr(self._local, "defer", False):
+                    self._dropped[category] += 1
+                    raise RequestDropped(
+                        f"{self.remaining:g} reddit request(s) left for {wait:.0f} seconds"
+                    )
+                self._condition.wait(wait)
+            if self.remaining is not None:
+                self.remaining -= 1  # Until the response reports the actual count
+            self._used[category] += 1
+
+    @contextmanager
+    def deferring(self):
+        # Low priority requests made by this thread wait rather than be dropped
+        self._local.defer = True
+        try:
+            yield
+        finally:
+            self._local.defer = False
+
+    def log_usage(self):
+        with self._condition:
+            used, self._used = self._used, Counter()
+            dropped, self._dropped = self._dropped, Counter()
+            remaining = self.remaining
+        logger.info(
+            "reddit requests: "
+            + ", ".join(f"{category}={used[category]}" for category in CATEGORIES)
+            + "".join(
+                f", {category} dropped={dropped[category]}" for category in dropped
+            )
+            + f"; {'unknown' if remaining is None else f'{remaining:g}'} remaining"
+        )
+
+    def record(self, response):
+        headers = response.headers
+        if "x-ratelimit-remaining" not in headers:
+            return
+        with self._condition:
+            self.remaining = float(headers["x-ratelimit-remaining"])
+            self._reset_at = time.monotonic() + float(headers["x-ratelimit-reset"])
+            self._condition.notify_all()
+
+    def requestor(self, base=None):
+        if base is None:
+            from prawcore import Requestor as base
+
+        scheduler = self
+
+        class SchedulingRequestor(base):
+            def request(self, method, url, *args, **kwargs):
+                scheduler.admit(scheduler.classify(method, url))
+                response = super().request(method, url, *args, **kwargs)
+                scheduler.record(response)
+                return response
+
+        return SchedulingRequestor
@@ -18,18 +18,53 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import hashlib
 import logging
+import threading
+from collections import Counter
 from datetime import datetime
 from decimal import Decimal
 from urllib.parse import quote_plus
 
 from prawcore.exceptions import NotFound
 
+from .scheduler import RequestDropped
+
 MAX_WIKI_CONTENT = 511950  # Bytes
+REBUILD_PROGRESS_INTERVAL = 100  # pages
 
 logger = logging.getLogger(__package__)
 
 
+def _user_stats_lines(*, config, history, keys, total_received, total_tipped, username):
+    user_stats = [f"### Tipping Summary for u/{username}\n"]
+    if total_tipped:
+        user_stats.append(
+            f"Total Tipped: {format_coin(config, total_tipped.normalize())}\n"
+        )
+    if total_received:
+        user_stats.append(
+            f"Total Received: {format_coin(config, total_received.normalize())}\n"
+        )
+
+    user_stats.append("#### History\n")
+    user_stats.append("|".join(keys))
+    user_stats.append("|".join([":---"] * len(keys)))
+    for row in history:
+        history_entry = []
+        for key in keys:
+            history_entry.append(
+                format_value(
+                    config=config,
+                    key=key,
+                    username=username,
+                    value=row[key],
+                )
+            )
+        user_stats.append("|".join(history_entry))
+    return user_stats
+
+
 def format_coin(config, quantity):
     return f"{quantity:f} {config['coin']['symbol']}"
 
@@ -60,13 +95,121 @@ def format_value(*, compact=False, config, key, username=None, value):
     return value
 
 
+def publish_wiki(*, content, nyantip, page):
+    subreddit = nyantip.config["reddit"]["subreddit"]
+    wiki = nyantip.reddit.subreddit(subreddit).wiki[page]
+    try:
+        previous_content = wiki.content_md.strip()
+    except NotFound:
+        previous_content = None
+    if content.strip() != previous_content:
+        logger.debug(f"update_user_stats(): updating wiki {subreddit}/{page}")
+        wiki.edit(content=content)
+        return True
+    logger.debug(f"update_user_stats(): content not changed on wiki {subreddit}/{page}")
+    return False
+
+
+def rebuild_user_stats(*, force=False, nyantip, workers):
+    # Loads every user's totals and history with three queries, then renders
+    # and publishes the pages from `workers` threads. The hash of each published
+    # page is kept in `wiki_pages`, so pages whose content hasn't changed since
+    # are skipped and an interrupted rebuild picks up where it left off.
+    sql = nyantip.config["sql"]["userstats"]
+    database = nyantip.read_database
+    totals_received = dict(database.execute(sql["total_received_all"]).fetchall())
+    totals_tipped = dict(database.execute(sql["total_tipped_all"]).fetchall())
+    totals_received = {key.lower(): value for key, value in totals_received.items()}
+    totals_tipped = {key.lower(): value for key, value in totals_tipped.items()}
+
+    result = database.execute(sql["history_all"])
+    keys = result.keys()
+    histories = {}
+    for row in result:
+        for key in ("source", "destination"):
+            name = row[key]
+            if name and len(name) <= 20:  # Withdrawal destinations are addresses
+                histories.setdefault(name.lower(), (name, []))[1].append(row)
+    published = dict(
+        nyantip.database.execute("SELECT page, content_hash FROM wiki_pages").fetchall()
+    )
+    logger.info(f"rebuilding stats pages of {len(histories)} user(s)")
+
+    counts = Counter()
+    lock = threading.Lock()
+    pending = iter(sorted(histories.items()))
+    stopped = threading.Event()
+
+    def rebuild(username, history):
+        page = f"stats_{username}"
+        content = wiki_fit(
+            lines=_user_stats_lines(
+                config=nyantip.config,
+                history=history,
+                keys=keys,
+                total_received=totals_received.get(username.lower()),
+                total_tipped=totals_tipped.get(username.lower()),
+                username=username,
+            )
+        )
+        content_hash = hashlib.sha256(content.encode()).hexdigest()
+        if not force and published.get(page.lower()) == content_hash:
+            return "skipped"
+
+        # Wait for reddit's rate limit to reset rather than skip the page
+        with nyantip.reddit_scheduler.deferring():
+            edited = publish_wiki(content=content, nyantip=nyantip, page=page)
+        nyantip.database.execute(
+            "INSERT INTO wiki_pages (content_hash, page) VALUES (%s, %s) ON DUPLICATE KEY UPDATE content_hash = VALUES(content_hash)",
+            (content_hash, page.lower()),
+        )
+        return "updated" if edited else "unchanged"
+
+    def work():
+        while not stopped.is_set():
+            with lock:
+                _, item = next(pending, (None, None))
+            if item is None:
+                return
+            try:
+                outcome = rebuild(*item)
+            except Exception:
+                logger.exception(f"rebuilding the stats page of {item[0]} failed")
+                outcome = "failed"
+            with lock:
+                counts[outcome] += 1
+                done = sum(counts.values())
+            if done % REBUILD_PROGRESS_INTERVAL == 0:
+                logger.info(f"rebuilt {done} of {len(histories)} stats page(s)")
+
+    threads = [
+        threading.Thread(name=f"nyantip-rebuild-{i}", target=work)
+        for i in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        logger.info("stopping after the pages in progress")
+        stopped.set()
+        for thread in threads:
+            thread.join()
+        raise
+    finally:
+        summary = ", ".join(f"{key}={value}" for key, value in sorted(counts.items()))
+        logger.info(f"stats pages: {summary or 'none'}")
+    return counts
+
+
 def update_stats(nyantip=None):
     lines = []
 
     for stat, config in sorted(nyantip.config["sql"]["globalstats"].items()):
         logger.debug(f"update_stats(): getting stats for '{stat}'")
 
-        total = nyantip.database.execute(config["query"]).scalar_one()
+        total = nyantip.read_database.execute(config["query"]).scalar_one()
 
         lines.append(f"\n\n### {config['name']}\n")
         lines.append(f"{config['description']}: **{total}**\n")
@@ -77,7 +220,7 @@ def update_stats(nyantip=None):
 def update_tips(nyantip=None):
     tips = [f"### {nyantip.config['coin']['name']} Completed Tips\n"]
 
-    result = nyantip.database.execute(nyantip.config["sql"]["tips"])
+    result = nyantip.read_database.execute(nyantip.config["sql"]["tips"])
     tips.append("|".join(result.keys()))
     tips.append("|".join([":---"] * len(result.keys())))
 
@@ -91,70 +234,36 @@ def update_tips(nyantip=None):
 
 
 def update_user_stats(*, nyantip, username):
-    user_stats = [f"### Tipping Summary for u/{username}\n"]
-
-    total = nyantip.database.execute(
-        nyantip.config["sql"]["userstats"]["total_tipped"], username
+    sql = nyantip.config["sql"]["userstats"]
+    database = nyantip.read_database
+    total_tipped = database.execute(sql["total_tipped"], username).scalar_one_or_none()
+    total_received = database.execute(
+        sql["total_received"], username
     ).scalar_one_or_none()
-    if total:
-        user_stats.append(
-            f"Total Tipped: {format_coin(nyantip.config, total.normalize())}\n"
-        )
-
-    total = nyantip.database.execute(
-        nyantip.config["sql"]["userstats"]["total_received"], username
-    ).scalar_one_or_none()
-    if total:
-        user_stats.append(
-            f"Total Received: {format_coin(nyantip.config, total.normalize())}\n"
-        )
-
-    user_stats.append("#### History\n")
-    result = nyantip.database.execute(
-        nyantip.config["sql"]["userstats"]["history"], (username, username)
-    )
+    result = database.execute(sql["history"], (username, username))
     if result.rowcount <= 0:
         logger.debug(f"update_user_stats(): skipping {username} with no history")
         return
 
-    user_stats.append("|".join(result.keys()))
-    user_stats.append("|".join([":---"] * len(result.keys())))
-
-    for row in result:
-        history_entry = []
-        for key in result.keys():
-            history_entry.append(
-                format_value(
-                    config=nyantip.config,
-                    key=key,
-                    username=username,
-                    value=row[key],
-                )
-            )
-        user_stats.append("|".join(history_entry))
-
     update_wiki(
-        lines=user_stats,
+        lines=_user_stats_lines(
+            config=nyantip.config,
+            history=result,
+            keys=result.keys(),
+            total_received=total_received,
+            total_tipped=total_tipped,
+            username=username,
+        ),
         nyantip=nyantip,
         page=f"stats_{username}",
     )
 
 
 def update_wiki(*, lines, nyantip, page):
-    subreddit = nyantip.config["reddit"]["subreddit"]
-    content = wiki_fit(lines=lines)
-    wiki = nyantip.reddit.subreddit(subreddit).wiki[page]
     try:
-        previous_content = wiki.content_md.strip()
-    except NotFound:
-        previous_content = None
-    if content.strip() != previous_content:
-        logger.debug(f"update_user_stats(): updating wiki {subreddit}/{page}")
-        wiki.edit(content=content)
-    else:
-        logger.debug(
-            f"update_user_stats(): content not changed on wiki {subreddit}/{page}"
-        )
+        publish_wiki(content=wiki_fit(lines=lines), nyantip=nyantip, page=page)
+    except RequestDropped as exception:
+        logger.info(f"update_wiki(): skipping {page}: {exception}")
 
 
 def wiki_fit(*, lines):
@@ -0,0 +1,3 @@
+Hey u/{{ message.author }}, the {{ config["coin"]["name"] }} wallet is temporarily unavailable, so your {{ action_name }} couldn't be processed yet. It has been queued and will go through automatically once the wallet is back, so there's no need to send it again.
+
+{% include 'footer.tpl' %}
@@ -1,3 +1,3 @@
-Hello u/{{ message.author }}. You have no history.
+Hello u/{{ message.author }}. You have no {{ "older " if older else "" }}history.
 
 {% include 'footer.tpl' %}
@@ -1,9 +1,17 @@
-Hello u/{{ message.author }}, here are your last 75 transactions.
+{% if older %}
+Hello u/{{ message.author }}, here are your next {{ history|length }} older transactions.
+{% else %}
+Hello u/{{ message.author }}, here are your last {{ history|length }} transactions.
+{% endif %}
 
 {{ "|".join(keys) }}
 {{ "|".join([":---"] * (keys|length)) }}
 {% for item in history %}
 {{   "|".join(item) }}
 {% endfor %}
+{% if cursor %}
+
+[^(older transactions)](/message/compose?to={{ config["reddit"]["username"] }}&subject=history&message=history%20older%20{{ cursor|join("%20") }})
+{% endif %}
 
 {% include 'footer.tpl' %}
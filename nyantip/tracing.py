@@ -0,0 +1,180 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_PATH = "nyantip-traces.jsonl"
+LEAF_KINDS = ("db", "reddit", "rpc")
+
+_local = threading.local()
+
+
+# Per-message traces of where processing time goes.
+#
+# `Tracer.trace` makes the current thread collect spans until the inbox item
+# is handled. Database queries, coin daemon RPC methods, reddit API requests,
+# and functions decorated with `log_function` each add a span while a trace is
+# active, and are otherwise untouched. Finished traces at least `threshold_ms`
+# long are appended to `path` as JSON lines of the form:
+#
+#   {"action": "tip", "id": "t1_abc", "ms": 812.4, "spans": [[depth, kind,
+#    name, offset_ms, duration_ms], ...], "start": 1624700000.0}
+class Tracer:
+    def __init__(self, *, config):
+        self.enabled = bool(config.get("enabled"))
+        self.path = config.get("path") or DEFAULT_PATH
+        self.threshold_ms = float(config.get("threshold_ms", 0))
+        self._fp = None
+        self._lock = threading.Lock()
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(",", ":"))
+        with self._lock:
+            if self._fp is None:
+                self._fp = open(self.path, "a", buffering=1)
+            self._fp.write(f"{line}\n")
+
+    def install(self, *, database):
+        if not self.enabled:
+            return
+        from sqlalchemy import event
+
+        event.listen(database, "after_cursor_execute", _after_cursor_execute)
+        event.listen(database, "before_cursor_execute", _before_cursor_execute)
+        event.listen(database, "handle_error", _handle_error)
+
+    @contextmanager
+    def trace(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        _local.trace = trace = {
+            "depth": 0,
+            "id": name,
+            "spans": [],
+            "start": time.time(),
+            "started": time.perf_counter(),
+            "tags": {},
+        }
+        try:
+            yield
+        finally:
+            _local.trace = None
+            duration = (time.perf_counter() - trace["started"]) * 1000
+            if duration >= self.threshold_ms:
+                self._write(
+                    {
+                        **trace["tags"],
+                        "id": trace["id"],
+                        "ms": round(duration, 3),
+                        "spans": trace["spans"],
+                        "start": round(trace["start"], 3),
+                    }
+                )
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    finish_span(getattr(context, "_nyantip_span", None))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._nyantip_span = start_span("db", " ".join(statement.split())[:80])
+
+
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    finish_span(getattr(context, "_nyantip_span", None))
+
+
+def finish_span(record):
+    trace = getattr(_local, "trace", None)
+    if trace is None or record is None or record[4] is not None:
+        return
+    now = (time.perf_counter() - trace["started"]) * 1000
+    record[4] = round(now - record[3], 3)
+    trace["depth"] -= 1
+
+
+@contextmanager
+def span(kind, name):
+    record = start_span(kind, name)
+    try:
+        yield
+    finally:
+        finish_span(record)
+
+
+def start_span(kind, name):
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return None
+    offset = (time.perf_counter() - trace["started"]) * 1000
+    record = [trace["depth"], kind, name, round(offset, 3), None]
+    trace["spans"].append(record)
+    trace["depth"] += 1
+    return record
+
+
+def summarize(path):
+    by_action = defaultdict(list)
+    with open(path) as fp:
+        for line in fp:
+            record = json.loads(line)
+            by_action[record.get("action") or "-"].append(record)
+
+    print(
+        f"{'action':10} {'traces':>7} {'mean ms':>9} {'p95 ms':>9}"
+        + "".join(f" {kind + ' ms':>9}" for kind in LEAF_KINDS)
+        + f" {'other ms':>9}"
+    )
+    calls = {}
+    for action, records in sorted(by_action.items()):
+        durations = sorted(record["ms"] for record in records)
+        kinds = defaultdict(float)
+        calls[action] = defaultdict(float)
+        for record in records:
+            for _, kind, name, _, duration in record["spans"]:
+                duration = duration or 0
+                if kind in LEAF_KINDS:
+                    kinds[kind] += duration
+                else:
+                    calls[action][name] += duration
+        count = len(records)
+        other = sum(durations) - sum(kinds.values())
+        print(
+            f"{action:10} {count:7} {sum(durations) / count:9.1f} {durations[int(0.95 * (count - 1))]:9.1f}"
+            + "".join(f" {kinds[kind] / count:9.1f}" for kind in LEAF_KINDS)
+            + f" {other / count:9.1f}"
+        )
+
+    for action, names in sorted(calls.items()):
+        if not names:
+            continue
+        count = len(by_action[action])
+        print(f"\n{action}: mean ms per traced call")
+        for name, total in sorted(names.items(), key=lambda item: -item[1])[:10]:
+            print(f"  {total / count:9.1f}  {name}")
+
+
+def tracing_requestor():
+    from prawcore import Requestor
+
+    class TracingRequestor(Requestor):
+        def request(self, method, url, *args, **kwargs):
+            with span("reddit", f"{method.upper()} {urlparse(url).path}"):
+                return super().request(method, url, *args, **kwargs)
+
+    return TracingRequestor
+
+
+def tag(**tags):
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace["tags"].update(tags)
@@ -1,4 +1,5 @@
 import logging
+from functools import partial
 
 from praw.exceptions import RedditAPIException
 from praw.models import Comment
@@ -26,7 +27,7 @@ class User(object):
         return self.name
 
     def balance(self, *, kind):
-        return self.nyantip.coin.balance(
+        return self.nyantip.accounts.balance(
             minconf=self.nyantip.config["coin"]["minconf"][kind], user=self.name
         )
 
@@ -44,7 +45,7 @@ class User(object):
 
     def is_registered(self):
         return bool(
-            self.nyantip.database.execute(
+            self.nyantip.execute(
                 "SELECT 1 FROM users WHERE username=%s", self
             ).one_or_none()
         )
@@ -53,6 +54,19 @@ class User(object):
     def message(self, *, body, message=None, reply_to_comment=False, subject):
         assert self.redditor is not None
 
+        send = partial(
+            self._send_message,
+            body=body,
+            message=message,
+            reply_to_comment=reply_to_comment,
+            subject=subject,
+        )
+        if self.nyantip.outbox:
+            send = partial(self.nyantip.outbox, send)
+        # Nothing is sent for an inbox item whose changes are rolled back
+        self.nyantip.after_commit(send)
+
+    def _send_message(self, *, body, message, reply_to_comment, subject):
         if message and (
             reply_to_comment
             or not (isinstance(message, Comment) or message.was_comment)
@@ -78,8 +92,12 @@ class User(object):
 
     @log_function(klass="User")
     def register(self):
-        address = self.nyantip.coin.generate_address(user=self.name)
+        address = None
+        if self.nyantip.address_pool:
+            address = self.nyantip.address_pool.claim(user=self.name)
+        if not address:
+            address = self.nyantip.coin.generate_address(user=self.name)
         logger.info(f"register({self.name}): got {self.nyantip.coin} address {address}")
-        self.nyantip.database.execute(
+        self.nyantip.execute(
             "INSERT INTO users (address,username) VALUES (%s, %s)", (address, self)
         )
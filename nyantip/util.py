@@ -1,5 +1,9 @@
 import logging
+import threading
 import time
+from collections import OrderedDict
+
+from .tracing import span
 
 logger = logging.getLogger(__package__)
 
@@ -10,6 +14,54 @@ class DummyMessage:
         self.context = context
 
 
+# LRU cache whose entries are forgotten `seconds` after they were set
+class ExpiringCache:
+    def __init__(self, max_items, seconds):
+        self._cache = LRUCache(max_items)
+        self.seconds = seconds
+
+    def get(self, key, default=None):
+        entry = self._cache.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._cache.pop(key)
+            return default
+        return value
+
+    def set(self, key, value):
+        self._cache.set(key, (value, time.monotonic() + self.seconds))
+
+
+class LRUCache:
+    def __init__(self, max_items):
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_items = max_items
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
 def log_function(*fields, klass=None, log_method=None, log_response=False):
     if not log_method:
         log_method = logger.debug
@@ -20,13 +72,13 @@ def log_function(*fields, klass=None, log_method=None, log_response=False):
                 f"{field}={kwargs[field]!r}" for field in fields if kwargs.get(field)
             )
 
+            name = f"{klass}.{function.__name__}" if klass else function.__name__
             start = time.time() * 1000
-            response = function(*args, **kwargs)
+            with span("call", name):
+                response = function(*args, **kwargs)
             duration = time.time() * 1000 - start
 
-            description = f"{function.__name__}({arguments})"
-            if klass:
-                description = f"{klass}.{description}"
+            description = f"{name}({arguments})"
             if log_response:
                 description = f"{description} = {response!r}"
 
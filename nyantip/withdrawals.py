@@ -0,0 +1,171 @@
+import logging
+import traceback
+from functools import partial
+
+from bitcoinrpc.authproxy import JSONRPCException
+
+from .actions import Action
+from .ledger import WITHDRAWALS_ACCOUNT
+from .rpc import CircuitOpen
+from .user import User
+
+logger = logging.getLogger(__package__)
+
+
+# Sends queued withdrawals together as a single `sendmany` transaction.
+#
+# A validated withdrawal moves the amount plus the transaction fee from the
+# user into the `@withdrawals` account and is saved as a pending action. The
+# queue is flushed once it holds `batch_size` withdrawals or the oldest has
+# waited `batch_seconds`. Pending rows are locked while the batch is sent, so a
+# withdrawal can only ever be included in one batch. Because a whole batch pays
+# a single network fee, the fees users are charged beyond it remain in the
+# `@withdrawals` account.
+#
+# Without `batch`, every withdrawal is a batch of one that is sent as soon as it
+# has been committed, which keeps the same protection against double sends.
+class WithdrawalBatcher:
+    def __init__(self, *, config, nyantip):
+        batch = bool(config.get("batch"))
+        self.account = User(name=WITHDRAWALS_ACCOUNT, nyantip=nyantip)
+        self.batch_seconds = int(config.get("batch_seconds", 60)) if batch else 0
+        self.batch_size = int(config.get("batch_size", 25)) if batch else 1
+        self.nyantip = nyantip
+        self._queued = {}
+
+    def _action(self, row):
+        action = self._queued.pop(row["message_id"], None)
+        if action is None:  # Queued by another instance or before a restart
+            action = Action(
+                action="withdraw",
+                amount=row["amount"].normalize(),
+                destination=row["destination"],
+                message=self.nyantip.reddit.inbox.message(row["message_id"]),
+                nyantip=self.nyantip,
+            )
+        return action
+
+    def add(self, action):
+        self._queued[action.message.id] = action
+        pending = self.nyantip.execute(
+            "SELECT COUNT(*) FROM actions WHERE action = 'withdraw' AND status = 'pending'"
+        ).scalar_one()
+        logger.info(f"queued withdraw {action.message.id} ({pending} pending)")
+        if pending >= self.batch_size:
+            # `flush` uses its own connection, so it has to see this withdrawal committed
+            self.nyantip.after_commit(self.flush)
+
+    def _refund(self, action):
+        # Atomic with the status update when balances are kept in the ledger
+        fee = self.nyantip.config["coin"]["transaction_fee"]
+        with self.nyantip.unit_of_work():
+            self.nyantip.accounts.send(
+                amount=action.amount + fee,
+                destination=action.source,
+                source=self.account,
+            )
+            if not self.nyantip.ledger:
+                self.nyantip.on_rollback(
+                    partial(
+                        self.nyantip.accounts.send,
+                        amount=action.amount + fee,
+                        destination=self.account,
+                        source=action.source,
+                    )
+                )
+            result = self.nyantip.execute(
+                "UPDATE actions SET status = 'failed' WHERE message_id = %s AND status = 'sending'",
+                action.message.id,
+            )
+            if result.rowcount != 1:
+                raise Exception(f"withdraw {action.message.id} is no longer sending")
+
+    def _set_status(self, message_ids, *, status, transaction_id=None):
+        self.nyantip.execute(
+            f"UPDATE actions SET status = %s, transaction_id = %s WHERE status = 'sending' AND message_id IN ({', '.join(['%s'] * len(message_ids))})",
+            (status, transaction_id, *message_ids),
+        )
+
+    def flush(self):
+        with self.nyantip.database.begin() as connection:
+            rows = connection.execute(
+                "SELECT *, created_at <= NOW() - INTERVAL %s SECOND AS due FROM actions WHERE action = 'withdraw' AND status = 'pending' ORDER BY created_at LIMIT %s FOR UPDATE",
+                (self.batch_seconds, self.batch_size),
+            ).fetchall()
+            if not rows or (
+                len(rows) < self.batch_size and not any(row["due"] for row in rows)
+            ):
+                return
+            message_ids = [row["message_id"] for row in rows]
+            # Committed before sending, so a batch is never sent twice
+            connection.execute(
+                f"UPDATE actions SET status = 'sending' WHERE message_id IN ({', '.join(['%s'] * len(message_ids))})",
+                message_ids,
+            )
+
+        amounts = {}
+        for row in rows:
+            amounts[row["destination"]] = (
+                amounts.get(row["destination"], 0) + row["amount"]
+            )
+        try:
+            transaction_id = self.nyantip.accounts.send_many(
+                amounts=amounts, source=self.account.name
+            )
+        except CircuitOpen:
+            # Nothing was sent; the batch waits for the next flush
+            self._set_status(message_ids, status="pending")
+            raise
+        except JSONRPCException:
+            # The daemon rejected the transaction, so nothing was sent
+            logger.exception(f"sending batch of {len(rows)} withdraw(s) failed")
+            transaction_id = None
+        except Exception:
+            # The transaction may have been broadcast before the error
+            error = traceback.format_exc()
+            logger.exception(
+                f"batch of {len(rows)} withdraw(s) may have been sent; left as 'sending' for manual reconciliation: {', '.join(message_ids)}"
+            )
+            self.nyantip.failures.add(
+                error=error, name=f"withdraw batch {', '.join(message_ids)}"
+            )
+            return
+
+        if transaction_id:
+            with self.nyantip.unit_of_work():
+                self._set_status(
+                    message_ids, status="completed", transaction_id=transaction_id
+                )
+                if self.nyantip.ledger:
+                    # The batch's single network fee leaves with the coins sent
+                    self.nyantip.ledger.withdraw(
+                        amount=sum(amounts.values())
+                        + self.nyantip.config["coin"]["transaction_fee"],
+                        source=self.account,
+                        transaction_id=transaction_id,
+                    )
+        logger.info(
+            f"batch of {len(rows)} withdraw(s) {'sent as ' + transaction_id if transaction_id else 'failed'}"
+        )
+
+        for row in rows:
+            action = self._action(row)
+            if transaction_id:
+                self.nyantip.history_cache.pop(action.source.name.lower())
+                action.transaction_id = transaction_id
+                action.notify_withdraw()
+                continue
+
+            try:
+                self._refund(action)
+            except Exception:
+                error = traceback.format_exc()
+                logger.exception(
+                    f"refunding withdraw {row['message_id']} failed; left as 'sending' for manual reconciliation"
+                )
+                self.nyantip.failures.add(
+                    error=error, name=f"withdraw refund {row['message_id']}"
+                )
+                continue
+            self.nyantip.history_cache.pop(action.source.name.lower())
+            action.notify_withdraw_failed()